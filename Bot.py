@@ -1,35 +1,83 @@
 import asyncio
-import pandas as pd
+import functools
 from openpyxl import load_workbook
 from aiogram import Bot, Dispatcher, types, F
-from aiogram.filters import CommandStart, Command
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile
+from aiogram.filters import CommandStart, Command, CommandObject
+from aiogram.types import (ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton,
+                           FSInputFile, BufferedInputFile)
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
 import re
 import os
-import shutil
+from dataclasses import replace
+from datetime import datetime
+from typing import Optional
 from dotenv import load_dotenv
-from Generator import ScheduleGenerator
-from data_processor import DataProcessor
+from Generator import (MultiVenueScheduler, ScheduleCalendar, ScheduleGenerator, ScheduleIndex,
+                       ScheduleResultCache, ScheduleSlot, ScheduleViewCache, Venue)
+from data_processor import DataProcessor, ParsedUploadCache
+from message_queue import OutboundQueue
+from schedule_editor import WorkbookEditor, replace_workbook
+from workers import WorkerPool, generate_in_pool, parse_upload, reschedule_subgroup, write_file
 
 load_dotenv()
 
 TOKEN = os.getenv("TOKEN")
-EXCEL_FILE = os.getenv("EXCEL_FILE", "rasp_prepare_94.xlsx")
+MAX_UPLOAD_ROWS = int(os.getenv("MAX_UPLOAD_ROWS", DataProcessor.MAX_ROWS))
+MAX_UPLOAD_COLUMNS = int(os.getenv("MAX_UPLOAD_COLUMNS", DataProcessor.MAX_COLUMNS))
+UPLOAD_CACHE_SIZE = int(os.getenv("UPLOAD_CACHE_SIZE", 32))
+SCHEDULE_CACHE_SIZE = int(os.getenv("SCHEDULE_CACHE_SIZE", 16))
+# Каталог для сохранения готовых расписаний между перезапусками; пусто — только в памяти
+SCHEDULE_CACHE_DIR = os.getenv("SCHEDULE_CACHE_DIR") or None
+MAX_VENUES = int(os.getenv("MAX_VENUES", 5))
+VIEW_CACHE_SIZE = int(os.getenv("VIEW_CACHE_SIZE", 256))
+VIEW_CACHE_TTL = int(os.getenv("VIEW_CACHE_TTL", 3600))  # секунд без обращений до удаления индекса просмотра
+# Пул для разбора файлов и генерации: процессов, одновременных задач, таймауты в секундах
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", 0)) or None  # по умолчанию — по числу ядер, не больше 4
+MAX_CONCURRENT_TASKS = int(os.getenv("MAX_CONCURRENT_TASKS", 0)) or None  # по умолчанию — по числу процессов
+IO_THREADS = int(os.getenv("IO_THREADS", 8))
+UPLOAD_TIMEOUT = float(os.getenv("UPLOAD_TIMEOUT", 60))
+GENERATION_TIMEOUT = float(os.getenv("GENERATION_TIMEOUT", 180))
+IO_TIMEOUT = float(os.getenv("IO_TIMEOUT", 30))
+# Правки расписания, пришедшие в течение этого числа секунд, записываются в файл одним сохранением
+EDIT_WRITE_BEHIND = float(os.getenv("EDIT_WRITE_BEHIND", 0))
+# Лимиты исходящих сообщений: всего в секунду, в секунду на чат и подряд после простоя, в секунду на группу
+SEND_RATE = float(os.getenv("SEND_RATE", 25))
+CHAT_SEND_RATE = float(os.getenv("CHAT_SEND_RATE", 1))
+CHAT_SEND_BURST = int(os.getenv("CHAT_SEND_BURST", 3))
+GROUP_SEND_RATE = float(os.getenv("GROUP_SEND_RATE", 20 / 60))
+# Если новое сообщение будет ждать отправки дольше стольких секунд, пользователь получает предупреждение
+SEND_WAIT_NOTICE = float(os.getenv("SEND_WAIT_NOTICE", 10))
 
 
 def get_user_schedule_file(user_id: int) -> str:
     return f"current_schedule_{user_id}.xlsx"
 
 
-if not TOKEN:
-    raise ValueError("❌ Токен не найден! Создайте файл .env и добавьте TOKEN=your_bot_token")
+COURT_SHEET_RE = re.compile(r"Корт (\d+)$")
+VENUE_BREAK_RE = re.compile(r"^зал\s*(\d+)\s*:\s*(.+)$", re.IGNORECASE)
+
 
-bot = Bot(token=TOKEN)
 storage = MemoryStorage()
 dp = Dispatcher(storage=storage)
+# Индекс последнего сгенерированного расписания пользователя для команд /now, /next, /when
+SCHEDULE_INDEXES: dict = {}
+# Генератор этого расписания (с восстановленным состоянием) — для пересчёта после правок
+SCHEDULE_GENERATORS: dict = {}
+
+# Создаются в main(): процессы пула (spawn) заново импортируют этот модуль как __mp_main__,
+# и всё, что создаётся при импорте, появлялось бы в каждом процессе
+bot: Optional[Bot] = None
+UPLOAD_CACHE: Optional[ParsedUploadCache] = None
+SCHEDULE_CACHE: Optional[ScheduleResultCache] = None
+# Индексы просмотра «группа → подгруппа → этапы» по файлам расписаний пользователей
+VIEW_CACHE: Optional[ScheduleViewCache] = None
+# Блокирующая работа выполняется вне цикла событий, чтобы бот отвечал другим пользователям
+WORKERS: Optional[WorkerPool] = None
+EDITOR: Optional[WorkbookEditor] = None
+# Массовые отправки (сводка, тексты кортов, файлы) идут через общую очередь с лимитами Telegram
+OUTBOX: Optional[OutboundQueue] = None
 
 
 class ScheduleStates(StatesGroup):
@@ -44,117 +92,153 @@ class GenerateStates(StatesGroup):
     waiting_for_file = State()
     collecting_exercise_times = State()
     entering_start_time = State()
+    entering_courts = State()
+    entering_breaks = State()
     confirm_generation = State()
 
 
-def cleanup_temp_files(data: dict):
-    if 'user_file_path' in data and os.path.exists(data['user_file_path']):
-        os.remove(data['user_file_path'])
-    if 'processed_file' in data and os.path.exists(data['processed_file']):
-        os.remove(data['processed_file'])
+def get_hall_courts_count(user_id: int, group: str, subgroup: str) -> int:
+    # В сгенерированном расписании по одному листу на корт (плюс лист статистики);
+    # при нескольких залах листы называются «<зал> - Корт N» — считаем корты зала, где выступает подгруппа
+    schedule_file = get_user_schedule_file(user_id)
+    index = get_view_index(user_id)
+    stages = index.stages(group, subgroup) if index else []
+    if not stages:
+        return ScheduleGenerator.DEFAULT_COURTS
+    hall = COURT_SHEET_RE.sub('', stages[0].sheet)
+    wb = load_workbook(schedule_file, read_only=True)
+    try:
+        numbers = [int(match.group(1)) for match in map(COURT_SHEET_RE.search, wb.sheetnames)
+                   if match and match.string[:match.start()] == hall]
+        return max(numbers, default=ScheduleGenerator.DEFAULT_COURTS)
+    finally:
+        wb.close()
+
+
+def get_venue_name(number: int) -> str:
+    return f"Зал {number}"
+
+
+def parse_venue_calendars(breaks_spec: str, venues_count: int) -> list:
+    """Календарь перерывов каждого зала: строки «Зал N: ...» относятся только к залу N, остальные — ко всем"""
+    common, own = [], [[] for _ in range(venues_count)]
+    for line in re.split(r"[;\n]", breaks_spec):
+        line = line.strip()
+        if not line:
+            continue
+        match = VENUE_BREAK_RE.match(line)
+        if match is None:
+            common.append(line)
+        elif 1 <= int(match.group(1)) <= venues_count:
+            own[int(match.group(1)) - 1].append(match.group(2))
+        else:
+            raise ValueError(f"Нет зала с номером {match.group(1)}")
+    return [
+        ScheduleCalendar.parse("\n".join(common + lines)) if common or lines else ScheduleGenerator.default_calendar()
+        for lines in own
+    ]
 
 
-def load_groups(user_id: int):
-    schedule_file = get_user_schedule_file(user_id)
-    if not os.path.exists(schedule_file):
-        return []
+def get_view_index(user_id: int):
+    # Индекс строится при генерации; после перезапуска или изменения файла — один раз по файлу
+    return VIEW_CACHE.get(get_user_schedule_file(user_id))
 
-    groups = set()
-    try:
-        excel_file = pd.ExcelFile(schedule_file)
-        for sheet_name in excel_file.sheet_names:
-            df = pd.read_excel(schedule_file, sheet_name=sheet_name)
-            if 'Группа' in df.columns:
-                for group in df['Группа'].dropna().unique():
-                    groups.add(str(group))
-        return sorted(list(groups))
-    except Exception as e:
-        print(f"Ошибка при загрузке групп: {e}")
-        return []
 
+def load_groups(user_id: int):
+    index = get_view_index(user_id)
+    return index.groups if index else []
 
-def load_subgroups(group_name, user_id: int):
-    schedule_file = get_user_schedule_file(user_id)
-    if not os.path.exists(schedule_file):
-        return []
 
-    subgroups = set()
-    try:
-        excel_file = pd.ExcelFile(schedule_file)
-        for sheet_name in excel_file.sheet_names:
-            df = pd.read_excel(schedule_file, sheet_name=sheet_name)
-            if 'Группа' in df.columns and 'Подгруппа' in df.columns:
-                # Фильтруем по выбранной группе
-                group_df = df[df['Группа'] == group_name]
-                for subgroup in group_df['Подгруппа'].dropna().unique():
-                    subgroups.add(str(subgroup))
-        return sorted(list(subgroups))
-    except Exception as e:
-        print(f"Ошибка при загрузке подгрупп: {e}")
-        return []
+def load_subgroups(group_name, user_id: int):
+    index = get_view_index(user_id)
+    return index.subgroups(group_name) if index else []
 
 
 def get_schedule_info(group_name, subgroup_name, user_id: int):
-    schedule_file = get_user_schedule_file(user_id)
-    if not os.path.exists(schedule_file):
+    index = get_view_index(user_id)
+    stages = index.stages(group_name, subgroup_name) if index else []
+    if not stages:
         return None
 
-    try:
-        excel_file = pd.ExcelFile(schedule_file)
-        stages_info = []
-
-        for sheet_name in excel_file.sheet_names:
-            df = pd.read_excel(schedule_file, sheet_name=sheet_name)
-
-            if 'Группа' in df.columns and 'Подгруппа' in df.columns:
-                matches = df[(df['Группа'] == group_name) & (df['Подгруппа'] == subgroup_name)]
-
-                for _, row in matches.iterrows():
-                    stages_info.append({
-                        'court': sheet_name,
-                        'time': row.get('Время', '—'),
-                        'stage': row.get('Этап', '—'),
-                        'participants': row.get('Участников', '—'),
-                        'poomse': row.get('Пхумсе', '—')
-                    })
-
-        if not stages_info:
-            return None
-
-        stages_info.sort(key=lambda x: x['time'] if x['time'] != '—' else '99:99')
-
-        first_stage = stages_info[0]
-
-        all_poomse = []
-        stage_details = []
-        for stage in stages_info:
-            poomse = str(stage['poomse'])
-            if poomse and poomse != '—' and poomse not in all_poomse:
-                all_poomse.append(poomse)
-            stage_details.append(f"{stage['stage']} ({stage['time']}, {stage['court']})")
-
-        return {
-            "kort": first_stage['court'],
-            "start_time": first_stage['time'],
-            "participants": str(first_stage['participants']),
-            "poomse": ", ".join(all_poomse) if all_poomse else "—",
-            "stages": " → ".join(stage_details)
-        }
+    first_stage = stages[0]
+
+    all_poomse = []
+    stage_details = []
+    for stage in stages:
+        if stage.poomse and stage.poomse not in all_poomse:
+            all_poomse.append(stage.poomse)
+        stage_details.append(f"{stage.stage} ({stage.time}, {stage.sheet})")
+
+    return {
+        "kort": first_stage.sheet,
+        "start_time": first_stage.time,
+        "participants": str(first_stage.participants),
+        "poomse": ", ".join(all_poomse) if all_poomse else "—",
+        "stages": " → ".join(stage_details)
+    }
 
-    except Exception as e:
-        print(f"Ошибка при получении информации о расписании: {e}")
-        return None
+
+def stage_type(label: str) -> str:
+    # «отбор (заход 2)» -> «отбор»
+    return label.split(' (', 1)[0]
+
+
+def split_poomse(value: str) -> list:
+    return [p.strip() for p in value.split(",") if p.strip()]
+
+
+def add_poomse_edits(session, stages: list, value: str):
+    """Правки листов расписания для пхумсе подгруппы; stages — её выступления по времени"""
+    # Пхумсе по порядку этапов: отбор, полуфинал, финал; этапы без пхумсе в списке очищаются
+    types = list(dict.fromkeys(stage_type(stage.stage) for stage in stages))
+    poomse = dict(zip(types, split_poomse(value)))
+    for stage in stages:
+        session.set(stage.sheet, stage.row, 'Пхумсе', poomse.get(stage_type(stage.stage), ""))
+
+
+def update_schedule_index(user_id: int, group: str, subgroup: str, value: str):
+    """Повторяет правку пхумсе в индексе команд /now, /next, /when.
+
+    Слоты могут быть общими с кэшем результатов, поэтому изменённые слоты заменяются копиями.
+    """
+    index = SCHEDULE_INDEXES.get(user_id)
+    if index is None:
+        return
+    schedule = index.schedule
+    positions = [i for i, slot in enumerate(schedule)
+                 if slot.stage.group_name == group and slot.stage.subgroup_name == subgroup]
+    if not positions:
+        return
+
+    types = list(dict.fromkeys(stage_type(schedule[i].stage.stage_type) for i in positions))
+    poomse = dict(zip(types, split_poomse(value)))
+    for i in positions:
+        slot = schedule[i]
+        schedule[i] = replace(slot, stage=replace(slot.stage, exercise=poomse.get(slot.stage.stage_type, "")))
+    SCHEDULE_INDEXES[user_id] = ScheduleIndex(schedule)
 
 
-def update_excel_cell(sheet_name, row_idx, col_idx, value):
-    wb = load_workbook(EXCEL_FILE)
-    if sheet_name not in wb.sheetnames:
-        return False
-    ws = wb[sheet_name]
-    # openpyxl индексирует с 1
-    ws.cell(row=row_idx + 2, column=col_idx + 1, value=value)
-    wb.save(EXCEL_FILE)
-    return True
+async def apply_rescheduled_edit(user_id: int, group: str, subgroup: str, field: str, value: str) -> str:
+    """Правка времени начала, участников или корта: расписание пересчитывается, новое заменяет
+    файл пользователя и индексы. Возвращает текст ответа; ValueError — если правку нельзя применить"""
+    schedule_file = get_user_schedule_file(user_id)
+    # Под блокировкой файла правки одного расписания идут по очереди, каждая — к результату предыдущей
+    async with EDITOR.lock(schedule_file):
+        index, generator = SCHEDULE_INDEXES.get(user_id), SCHEDULE_GENERATORS.get(user_id)
+        if index is None or generator is None:
+            return ("❌ Пересчёт доступен только для расписания, сгенерированного после запуска бота. "
+                    "Сгенерируйте расписание заново.")
+        schedule, moved, excel_bytes, view_index = await WORKERS.run(
+            reschedule_subgroup, generator, index.schedule, group, subgroup, field, value
+        )
+        await WORKERS.run_io(replace_workbook, schedule_file, excel_bytes)
+        VIEW_CACHE.put(schedule_file, view_index)
+        SCHEDULE_INDEXES[user_id] = ScheduleIndex(schedule)
+
+    # Заданное время — не раньше которого начнётся подгруппа: корт в этот момент может быть ещё занят
+    first = view_index.stages(group, subgroup)[0]
+    return (f"✅ Расписание обновлено и пересчитано.\n"
+            f"Подгруппа начинает в {first.time} ({first.sheet}), сдвинуто выступлений: {moved}.")
 
 
 # === Обработчики просмотра/редактирования ===
@@ -170,6 +254,89 @@ async def start(message: types.Message, state: FSMContext):
     await state.clear()
 
 
+# === Команды «что сейчас / что дальше» ===
+def format_court(venue: str, court: int, title: bool = False) -> str:
+    if venue:
+        return f"{venue}, корт {court}"
+    return f"Корт {court}" if title else f"корт {court}"
+
+
+def format_slot_line(slot: ScheduleSlot) -> str:
+    return (f"{slot.start_time.strftime('%H:%M')}–{slot.end_time.strftime('%H:%M')}, "
+            f"{format_court(slot.venue, slot.court)}: "
+            f"{slot.stage.group_name}, {slot.stage.subgroup_name} ({slot.stage.stage_label})")
+
+
+async def get_schedule_index(message: types.Message):
+    index = SCHEDULE_INDEXES.get(message.from_user.id)
+    if index is None:
+        await message.answer("❌ Сначала сгенерируйте расписание: «🔧 Сгенерировать новое расписание».")
+    return index
+
+
+@dp.message(Command("now"))
+async def now_command(message: types.Message, command: CommandObject):
+    index = await get_schedule_index(message)
+    if index is None:
+        return
+
+    moment = index.offset(datetime.now())
+    args = (command.args or '').split()
+    # При нескольких залах номер корта выбирает этот корт во всех залах
+    courts = [(venue, court) for venue, court in index.courts if not args or str(court) == args[0]]
+    if args and not courts:
+        await message.answer("❌ Использование: /now [номер корта]")
+        return
+
+    lines = []
+    for venue, court in courts:
+        slot = index.current(court, moment, venue)
+        lines.append(format_slot_line(slot) if slot else
+                     f"{format_court(venue, court, title=True)}: сейчас нет выступлений")
+    await message.answer("🕒 Сейчас:\n" + "\n".join(lines))
+
+
+@dp.message(Command("next"))
+async def next_command(message: types.Message, command: CommandObject):
+    index = await get_schedule_index(message)
+    if index is None:
+        return
+
+    args = (command.args or '').split()
+    courts = [(venue, court) for venue, court in index.courts if args and str(court) == args[0]]
+    if not courts or (len(args) > 1 and not args[1].isdigit()):
+        await message.answer("❌ Использование: /next <номер корта> [сколько выступлений]")
+        return
+    count = min(int(args[1]) if len(args) > 1 else 3, 20)
+
+    moment = index.offset(datetime.now())
+    blocks = []
+    for venue, court in courts:
+        slots = index.upcoming(court, moment, count, venue)
+        if slots:
+            blocks.append(f"⏭ Дальше: {format_court(venue, court)}\n" + "\n".join(map(format_slot_line, slots)))
+        else:
+            blocks.append(f"{format_court(venue, court, title=True)}: больше выступлений нет.")
+    await message.answer("\n\n".join(blocks))
+
+
+@dp.message(Command("when"))
+async def when_command(message: types.Message, command: CommandObject):
+    index = await get_schedule_index(message)
+    if index is None:
+        return
+
+    if not command.args:
+        await message.answer("❌ Использование: /when <подгруппа>")
+        return
+
+    slots = index.next_for_subgroup(command.args, index.offset(datetime.now()))
+    if not slots:
+        await message.answer("❌ Предстоящих выступлений этой подгруппы не найдено.")
+        return
+    await message.answer("📍 Ближайшее выступление:\n" + "\n".join(map(format_slot_line, slots)))
+
+
 @dp.message(F.text == "📅 Просмотреть расписание")
 async def view_schedule(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
@@ -184,7 +351,7 @@ async def view_schedule(message: types.Message, state: FSMContext):
         )
         return
 
-    groups = load_groups(user_id)
+    groups = await WORKERS.run_io(load_groups, user_id)
     if not groups:
         await message.answer("❌ Не удалось загрузить группы из расписания.")
         return
@@ -203,13 +370,13 @@ async def choose_group(message: types.Message, state: FSMContext):
         return
 
     user_id = message.from_user.id
-    groups = load_groups(user_id)
-    if message.text not in groups:
+    index = await WORKERS.run_io(get_view_index, user_id)
+    if index is None or message.text not in index:
         await message.answer("❌ Такой группы нет. Выберите из списка.")
         return
 
     await state.update_data(selected_group=message.text)
-    subgroups = load_subgroups(message.text, user_id)
+    subgroups = index.subgroups(message.text)
     if not subgroups:
         await message.answer("❌ Подгруппы не найдены.")
         return
@@ -235,10 +402,14 @@ async def choose_subgroup(message: types.Message, state: FSMContext):
         await start(message, state)
         return
 
+    if message.text == "✏️ Редактировать":
+        await edit_schedule(message, state)
+        return
+
     user_id = message.from_user.id
     data = await state.get_data()
     group = data.get("selected_group")
-    info = get_schedule_info(group, message.text, user_id)
+    info = await WORKERS.run_io(get_schedule_info, group, message.text, user_id)
     if not info:
         await message.answer("❌ Подгруппа не найдена.")
         return
@@ -258,6 +429,7 @@ async def choose_subgroup(message: types.Message, state: FSMContext):
 
     keyboard = ReplyKeyboardMarkup(
         keyboard=[
+            [KeyboardButton(text="✏️ Редактировать")],
             [KeyboardButton(text="🔙 Назад")]
         ],
         resize_keyboard=True
@@ -273,6 +445,11 @@ async def back_handler(message: types.Message, state: FSMContext):
 
 @dp.message(F.text == "✏️ Редактировать")
 async def edit_schedule(message: types.Message, state: FSMContext):
+    data = await state.get_data()
+    if not data.get("selected_subgroup"):
+        await message.answer("❌ Сначала выберите подгруппу в «📅 Просмотреть расписание».")
+        return
+
     fields = ["⏰ Время начала", "👥 Участников", "🥋 Пхумсе", "🏟 Корт"]
     buttons = [[KeyboardButton(text=f)] for f in fields]
     buttons.append([KeyboardButton(text="❌ Отмена")])
@@ -299,11 +476,14 @@ async def choose_edit_field(message: types.Message, state: FSMContext):
         return
 
     await state.update_data(editing_field=internal_field)
+    data = await state.get_data()
+    courts_count = await WORKERS.run_io(get_hall_courts_count, message.from_user.id,
+                                        data["selected_group"], data["selected_subgroup"])
     prompts = {
         "start_time": "Введите новое время начала (формат ЧЧ:ММ, например 10:30):",
         "participants": "Введите новое количество участников (целое число):",
         "poomse": "Введите пхумсе через запятую (например: тхэгук иль джан, кибон иль джан):",
-        "kort": "Выберите корт:\n1 — Корт 1\n2 — Корт 2\n3 — Корт 3"
+        "kort": "Выберите корт:\n" + "\n".join(f"{c} — Корт {c}" for c in range(1, courts_count + 1))
     }
     await message.answer(prompts[internal_field])
     await state.set_state(ScheduleStates.editing_value)
@@ -325,8 +505,10 @@ async def input_new_value(message: types.Message, state: FSMContext):
             await message.answer("❌ Введите положительное целое число.")
             return
     elif field == "kort":
-        if value not in ["1", "2", "3"]:
-            await message.answer("❌ Введите 1, 2 или 3.")
+        courts_count = await WORKERS.run_io(get_hall_courts_count, message.from_user.id,
+                                            data["selected_group"], data["selected_subgroup"])
+        if not value.isdigit() or not 1 <= int(value) <= courts_count:
+            await message.answer(f"❌ Введите номер корта от 1 до {courts_count} (корты зала, где выступает подгруппа).")
             return
 
     await state.update_data(new_value=value)
@@ -347,35 +529,37 @@ async def confirm_edit(callback: types.CallbackQuery, state: FSMContext):
     data = await state.get_data()
     field = data["editing_field"]
     new_value = data["new_value"]
-    row_idx = data["current_info"]["row_index"]
-
-    # Преобразуем значение для Excel
-    if field == "kort":
-        letter_map = {"1": "k", "2": "u", "3": "d"}
-        excel_value = letter_map[new_value]
-        col_idx = 0
-    elif field == "start_time":
-        excel_value = new_value
-        col_idx = 7
-    elif field == "participants":
-        excel_value = int(new_value)
-        col_idx = 5
-    elif field == "poomse":
-        poomse_list = [p.strip() for p in new_value.split(",") if p.strip()]
-
-        for i, p in enumerate(poomse_list[:3]):
-            update_excel_cell("prep", row_idx, 8 + i, p)
-        for i in range(len(poomse_list), 3):
-            update_excel_cell("prep", row_idx, 8 + i, "")
-        await callback.message.edit_text("✅ Расписание успешно обновлено!")
+    group, subgroup = data["selected_group"], data["selected_subgroup"]
+    user_id = callback.from_user.id
+
+    # Правка применяется к выступлениям подгруппы в файле пользователя: все ячейки — одной записью
+    index = await WORKERS.run_io(get_view_index, user_id)
+    stages = index.stages(group, subgroup) if index else []
+    if not stages:
+        await callback.message.edit_text("❌ Подгруппа не найдена в расписании.")
         await start(callback.message, state)
         return
 
-    success = update_excel_cell("prep", row_idx, col_idx, excel_value)
-    if success:
-        await callback.message.edit_text("✅ Расписание успешно обновлено!")
-    else:
-        await callback.message.edit_text("❌ Ошибка при сохранении.")
+    try:
+        if field == "poomse":
+            # Пхумсе не влияет на время: правятся только ячейки
+            async with EDITOR.session(get_user_schedule_file(user_id)) as session:
+                add_poomse_edits(session, stages, new_value)
+            if session.result:
+                update_schedule_index(user_id, group, subgroup, new_value)
+                text = "✅ Расписание успешно обновлено!"
+            else:
+                text = "❌ Ошибка при сохранении."
+        else:
+            # Время, участники и корт сдвигают следующие выступления — расписание пересчитывается
+            text = await apply_rescheduled_edit(user_id, group, subgroup, field, new_value)
+    except ValueError as e:
+        text = f"❌ {e}"
+    except Exception as e:
+        print(f"Ошибка при сохранении правки: {e}")
+        text = "❌ Ошибка при сохранении."
+
+    await callback.message.edit_text(text)
 
     await start(callback.message, state)
 
@@ -410,6 +594,8 @@ async def start_generation(message: types.Message, state: FSMContext):
         "• Столбец 2: Упражнение для отбора (если нужен)\n"
         "• Столбец 3: Упражнение для полуфинала (если нужен)\n"
         "• Столбец 4: Упражнение для финала (обязательно)\n\n"
+        "Также можно отправить CSV (две таблицы, разделённые пустой строкой) "
+        "или JSON с ключами `groups` и `exercises`.\n\n"
         "📎 Пожалуйста, отправьте заполненный файл Excel.",
         parse_mode="Markdown"
     )
@@ -421,59 +607,101 @@ async def start_generation(message: types.Message, state: FSMContext):
 async def process_uploaded_file(message: types.Message, state: FSMContext):
     document = message.document
 
-    if not (document.file_name.endswith('.xlsx') or document.file_name.endswith('.xls')):
-        await message.answer("❌ Пожалуйста, отправьте файл Excel (.xlsx или .xls)")
+    extension = os.path.splitext(document.file_name or '')[1].lower()
+    if extension not in DataProcessor.FORMATS_BY_EXTENSION:
+        await message.answer("❌ Пожалуйста, отправьте файл Excel (.xlsx или .xls), CSV или JSON")
         return
 
     await message.answer("⏳ Обрабатываю файл...")
 
     try:
-        file_path = f"user_upload_{message.from_user.id}.xlsx"
-        await message.bot.download(document, destination=file_path)
-
-        # Обрабатываем файл через DataProcessor
-        processor = DataProcessor(file_path)
-        success, processed_file, exercises = processor.process(f"processed_{message.from_user.id}.xlsx")
-
-        if not success or not exercises:
-            await message.answer("❌ Ошибка при обработке файла. Проверьте структуру данных.")
-            # Удаляем временные файлы
-            if os.path.exists(file_path):
-                os.remove(file_path)
-            await start(message, state)
-            return
+        content = (await message.bot.download(document)).getvalue()
+        upload_key = ParsedUploadCache.content_hash(content)
+
+        # Повторная загрузка того же файла не разбирается заново
+        parsed = UPLOAD_CACHE.get(upload_key)
+        if parsed is None:
+            # Обрабатываем файл через DataProcessor (без промежуточного Excel) в пуле процессов
+            parsed, report_text = await WORKERS.run(
+                parse_upload, content, extension, MAX_UPLOAD_ROWS, MAX_UPLOAD_COLUMNS, timeout=UPLOAD_TIMEOUT
+            )
+            if parsed is None:
+                await message.answer(report_text or "❌ Ошибка при обработке файла. Проверьте структуру данных.")
+                await start(message, state)
+                return
+
+            UPLOAD_CACHE.put(upload_key, parsed)
 
         # Сохраняем данные в состояние
         await state.update_data(
-            user_file_path=file_path,
-            processed_file=processed_file,
-            exercises=exercises,
+            upload_key=upload_key,
+            group_records=parsed.group_records,
+            exercises=parsed.exercises,
             exercise_times={},
             current_exercise_index=0
         )
 
+        # Для уже знакомого файла предлагаем прежние времена упражнений
+        if parsed.exercise_times and all(ex in parsed.exercise_times for ex in parsed.exercises):
+            times_text = "\n".join(f"• {ex}: {parsed.exercise_times[ex]} мин" for ex in parsed.exercises)
+            keyboard = InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="✅ Использовать прежние", callback_data="reuse_exercise_times")],
+                [InlineKeyboardButton(text="✏️ Ввести заново", callback_data="enter_exercise_times")]
+            ])
+            await message.answer(
+                f"✅ Этот файл уже загружался.\n\n"
+                f"Ранее введённое время упражнений:\n{times_text}\n\n"
+                f"Использовать его?",
+                reply_markup=keyboard
+            )
+            return
+
         await message.answer(
             f"✅ Файл успешно обработан!\n"
-            f"Найдено {len(exercises)} уникальных упражнений.\n\n"
+            f"Найдено {len(parsed.exercises)} уникальных упражнений.\n\n"
             f"Теперь мне нужно узнать время выполнения каждого упражнения."
         )
 
         await ask_exercise_time(message, state)
 
+    except asyncio.TimeoutError:
+        await message.answer("❌ Файл обрабатывается слишком долго. Попробуйте файл меньшего размера.")
+        await start(message, state)
+
     except Exception as e:
         await message.answer(f"❌ Ошибка при обработке файла: {str(e)}")
-        # Удаляем временные файлы
-        if os.path.exists(file_path):
-            os.remove(file_path)
         await start(message, state)
 
 
+@dp.callback_query(F.data == "reuse_exercise_times")
+async def reuse_exercise_times(callback: types.CallbackQuery, state: FSMContext):
+    data = await state.get_data()
+    parsed = UPLOAD_CACHE.get(data.get('upload_key', ''))
+    if parsed is None:
+        await enter_exercise_times(callback, state)
+        return
+
+    await state.update_data(
+        exercise_times=dict(parsed.exercise_times),
+        current_exercise_index=len(data['exercises'])
+    )
+    await callback.message.edit_text("✅ Используется ранее введённое время упражнений.")
+    await ask_start_time(callback.message, state)
+
+
+@dp.callback_query(F.data == "enter_exercise_times")
+async def enter_exercise_times(callback: types.CallbackQuery, state: FSMContext):
+    await callback.message.edit_text("Введите время выполнения упражнений заново.")
+    await ask_exercise_time(callback.message, state)
+
+
 async def ask_exercise_time(message: types.Message, state: FSMContext):
     data = await state.get_data()
     exercises = data['exercises']
     current_index = data['current_exercise_index']
 
     if current_index >= len(exercises):
+        UPLOAD_CACHE.remember_exercise_times(data.get('upload_key'), data['exercise_times'])
         await ask_start_time(message, state)
         return
 
@@ -536,12 +764,75 @@ async def collect_start_time(message: types.Message, state: FSMContext):
     start_time = message.text.strip()
     await state.update_data(start_time=start_time)
 
-    # Показываем подтверждение
+    await message.answer(
+        f"🏟 Введите количество кортов (от 1 до {ScheduleGenerator.MAX_COURTS}, "
+        f"обычно {ScheduleGenerator.DEFAULT_COURTS}).\n"
+        f"Если соревнования идут в нескольких залах — число кортов каждого зала через запятую "
+        f"(до {MAX_VENUES} залов), например: 3, 2"
+    )
+    await state.set_state(GenerateStates.entering_courts)
+
+
+@dp.message(GenerateStates.entering_courts)
+async def collect_courts_count(message: types.Message, state: FSMContext):
+    values = [value.strip() for value in message.text.split(',')]
+    if not 1 <= len(values) <= MAX_VENUES or not all(
+            value.isdigit() and 1 <= int(value) <= ScheduleGenerator.MAX_COURTS for value in values):
+        await message.answer(
+            f"❌ Введите целое число от 1 до {ScheduleGenerator.MAX_COURTS} "
+            f"или числа кортов залов через запятую (до {MAX_VENUES} залов)."
+        )
+        return
+
+    venue_courts = [int(value) for value in values]
+    await state.update_data(venue_courts=venue_courts)
+
+    venue_hint = ""
+    if len(venue_courts) > 1:
+        venue_hint = ("Перерыв только одного зала начните с его номера: `Зал 2: 13:00-13:30 Обед`, "
+                      "остальные перерывы действуют во всех залах.\n\n")
+    await message.answer(
+        "🍽 Введите перерывы, каждый с новой строки или через «;», в формате\n"
+        "`[день] ЧЧ:ММ-ЧЧ:ММ [название]`, например:\n"
+        "`12:30-14:00 Обед`\n"
+        "`1 19:00-09:00 Зал закрыт`\n"
+        "`2 13:00-13:30 Обед`\n\n"
+        + venue_hint +
+        "Отправьте «-», чтобы оставить стандартный обед (12:30 - 14:00).",
+        parse_mode="Markdown"
+    )
+    await state.set_state(GenerateStates.entering_breaks)
+
+
+@dp.message(GenerateStates.entering_breaks)
+async def collect_breaks(message: types.Message, state: FSMContext):
+    value = message.text.strip()
+    breaks_spec = '' if value == '-' else value
     data = await state.get_data()
+    venue_courts = data['venue_courts']
+    try:
+        calendars = parse_venue_calendars(breaks_spec, len(venue_courts))
+    except ValueError as e:
+        await message.answer(f"❌ {e}. Попробуйте еще раз.")
+        return
+
+    await state.update_data(breaks_spec=breaks_spec)
+
+    # Показываем подтверждение
     exercise_times = data['exercise_times']
+    start_time = data['start_time']
 
     summary = "📋 *Сводка параметров:*\n\n"
-    summary += f"⏰ Время начала: `{start_time}`\n\n"
+    summary += f"⏰ Время начала: `{start_time}`\n"
+    for number, (courts, calendar) in enumerate(zip(venue_courts, calendars), 1):
+        if len(venue_courts) > 1:
+            summary += f"\n🏛 *{ScheduleGenerator.strip_markdown(get_venue_name(number))}*\n"
+        summary += f"🏟 Кортов: `{courts}`\n"
+        summary += "🍽 Перерывы:\n"
+        for interval in calendar.intervals:
+            day = int(interval.start // ScheduleCalendar.DAY) + 1
+            summary += f"• день {day}, {interval.time_range}: {ScheduleGenerator.escape_markdown(interval.label)}\n"
+    summary += "\n"
     summary += "*Время выполнения упражнений:*\n"
     for ex, time in exercise_times.items():
         summary += f"• {ex}: {time} мин\n"
@@ -550,6 +841,14 @@ async def collect_start_time(message: types.Message, state: FSMContext):
 
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="✅ Да, сгенерировать", callback_data="generate_schedule")],
+        [InlineKeyboardButton(
+            text=f"🧠 Оптимизировать (до {ScheduleGenerator.OPTIMIZE_TIME_BUDGET:g} сек)",
+            callback_data="generate_schedule_optimized"
+        )],
+        [InlineKeyboardButton(
+            text=f"🔀 Этапы на любых кортах (отдых {ScheduleGenerator.DEFAULT_REST_MINUTES} мин)",
+            callback_data="generate_schedule_stages"
+        )],
         [InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_generation")]
     ])
 
@@ -557,124 +856,142 @@ async def collect_start_time(message: types.Message, state: FSMContext):
     await state.set_state(GenerateStates.confirm_generation)
 
 
-@dp.callback_query(F.data == "generate_schedule")
+# Кнопка подтверждения -> режим генерации
+GENERATION_MODES = {
+    "generate_schedule": "greedy",
+    "generate_schedule_optimized": "optimize",
+    "generate_schedule_stages": "stages",
+}
+
+
+@dp.callback_query(F.data.in_(set(GENERATION_MODES)))
 async def generate_schedule(callback: types.CallbackQuery, state: FSMContext):
     await callback.message.edit_text("⏳ Генерирую расписание, пожалуйста подождите...")
 
     try:
         data = await state.get_data()
-        processed_file = data['processed_file']
+        group_records = data['group_records']
         exercise_times = data['exercise_times']
         start_time = data['start_time']
-
-        # Создаём генератор с обработанным файлом
-        generator = ScheduleGenerator(processed_file)
+        venue_courts = data.get('venue_courts', [ScheduleGenerator.DEFAULT_COURTS])
+        calendars = parse_venue_calendars(data.get('breaks_spec') or '', len(venue_courts))
+
+        # Создаём генератор с данными, переданными из DataProcessor в памяти;
+        # для нескольких залов группы делятся между залами, залы считаются параллельно
+        if len(venue_courts) > 1:
+            generator = MultiVenueScheduler(group_records, [
+                Venue(get_venue_name(number), courts, calendar)
+                for number, (courts, calendar) in enumerate(zip(venue_courts, calendars), 1)
+            ])
+        else:
+            generator = ScheduleGenerator(group_records, courts=venue_courts[0], calendar=calendars[0])
 
         # Устанавливаем время упражнений
         generator.set_exercise_times(exercise_times)
 
-        # Генерируем расписание
-        schedule = generator.generate_schedule(start_time)
-
-        if not schedule:
-            await callback.message.answer("❌ Не удалось сгенерировать расписание. Проверьте данные в Excel.")
-            # Очищаем временные файлы
-            cleanup_temp_files(data)
-            await start(callback.message, state)
-            return
-
-        # Сохраняем в файл
-        output_file = generator.save_schedule_to_excel(schedule, f"schedule_{callback.from_user.id}.xlsx")
-
-        # Копируем файл для функции просмотра (персональный файл пользователя)
-        user_schedule_file = get_user_schedule_file(callback.from_user.id)
-        shutil.copy(output_file, user_schedule_file)
-
-        # Формируем сводку
-        total_slots = len(schedule)
-        courts = {1: 0, 2: 0, 3: 0}
-        for slot in schedule:
-            courts[slot.court] += 1
-
-        end_time = max(slot.end_time for slot in schedule)
-
+        # Генерируем расписание: жадно, с оптимизацией времени окончания или по этапам.
+        # Те же входные данные (повтор после отмены, двойное нажатие) берутся из кэша
+        mode = GENERATION_MODES[callback.data]
+        cache_key = generator.fingerprint(start_time, mode)
+        result = SCHEDULE_CACHE.get(cache_key)
+        if result is None:
+            # Генерация, тексты, Excel и статистика считаются в пуле процессов, залы — параллельно
+            result = await generate_in_pool(WORKERS, generator, start_time, mode, timeout=GENERATION_TIMEOUT)
+
+            if result is None:
+                await callback.message.answer("❌ Не удалось сгенерировать расписание. Проверьте данные в Excel.")
+                await start(callback.message, state)
+                return
+
+            SCHEDULE_CACHE.put(cache_key, result)
+        schedule = result.schedule
+
+        # Сохраняем персональный файл пользователя и индекс для функции просмотра
+        schedule_file = get_user_schedule_file(callback.from_user.id)
+        async with EDITOR.lock(schedule_file):
+            await WORKERS.run_io(write_file, schedule_file, result.excel_bytes)
+            VIEW_CACHE.put(schedule_file, result.view_index)
+            # Генерация шла в другом процессе или взята из кэша: состояние генератора восстанавливается для правок
+            generator.restore_state(schedule, mode)
+            SCHEDULE_GENERATORS[callback.from_user.id] = generator
+            SCHEDULE_INDEXES[callback.from_user.id] = ScheduleIndex(schedule)
+
+        # Формируем сводку: статистика считается генератором за один проход по слотам
         summary = (
             f"✅ *Расписание успешно сгенерировано!*\n\n"
             f"📊 Статистика:\n"
-            f"• Всего выступлений: {total_slots}\n"
-            f"• Корт 1: {courts[1]} выступлений\n"
-            f"• Корт 2: {courts[2]} выступлений\n"
-            f"• Корт 3: {courts[3]} выступлений\n"
+            f"• Всего выступлений: {len(schedule)}\n"
             f"• Начало: {start_time}\n"
-            f"• Окончание: {end_time.strftime('%H:%M')}\n"
+            f"{ScheduleGenerator.escape_markdown(result.statistics.format_text())}\n"
+        )
+        if result.backfilled_minutes > 0:
+            summary += f"• Заполнено простоя перед перерывами: {result.backfilled_minutes:.0f} мин\n"
+
+        chat_id = callback.message.chat.id
+        wait = OUTBOX.estimated_wait(chat_id)
+        if wait > SEND_WAIT_NOTICE:
+            await callback.message.answer(f"⏳ Бот сейчас загружен, расписание придёт примерно через {wait:.0f} сек.")
+
+        # Сводка, расписание каждого корта (по залам; части уже укладываются в лимит Telegram) и файл
+        # ставятся в очередь отправки; в чате они приходят в этом порядке
+        sends = [OUTBOX.submit(chat_id, functools.partial(callback.bot.send_message, chat_id, summary,
+                                                          parse_mode="Markdown"))]
+        for court_messages in result.court_messages.values():
+            for part in court_messages:
+                sends.append(OUTBOX.submit(chat_id, functools.partial(callback.bot.send_message, chat_id, part,
+                                                                      parse_mode="Markdown")))
+        file = BufferedInputFile(result.excel_bytes, filename=f"schedule_{callback.from_user.id}.xlsx")
+        sends.append(OUTBOX.submit(chat_id, functools.partial(callback.bot.send_document, chat_id, file,
+                                                              caption="📄 Полное расписание в Excel")))
+        # Меню показывается после доставки расписания; ошибка любой отправки — как раньше, ошибка генерации
+        await asyncio.gather(*sends)
+
+    except asyncio.TimeoutError:
+        await callback.message.answer(
+            f"❌ Генерация не уложилась в {GENERATION_TIMEOUT:g} сек. Попробуйте жадный режим или меньше данных."
         )
-
-        await callback.message.answer(summary, parse_mode="Markdown")
-
-        # Отправляем расписание для каждого корта
-        for court_num in [1, 2, 3]:
-            court_schedule_text = generator.format_schedule_as_text(schedule, court_num)
-
-            # Разбиваем на части, если текст слишком длинный (лимит Telegram - 4096 символов)
-            max_length = 4000  # Оставляем запас
-            if len(court_schedule_text) <= max_length:
-                await callback.message.answer(court_schedule_text, parse_mode="Markdown")
-            else:
-                # Разбиваем по блокам времени
-                parts = court_schedule_text.split('\n\n')
-                current_part = f"*КОРТ {court_num}* (часть 1)\n" + "━" * 50 + "\n\n"
-                part_num = 1
-
-                for block in parts[1:]:  # Пропускаем заголовок
-                    if len(current_part) + len(block) + 2 > max_length:
-                        # Отправляем текущую часть
-                        await callback.message.answer(current_part, parse_mode="Markdown")
-                        await asyncio.sleep(0.3)
-                        part_num += 1
-                        current_part = f"*КОРТ {court_num}* (часть {part_num})\n" + "━" * 50 + "\n\n"
-
-                    current_part += block + "\n\n"
-
-                # Отправляем последнюю часть
-                if current_part.strip():
-                    await callback.message.answer(current_part, parse_mode="Markdown")
-
-            await asyncio.sleep(0.5)  # Небольшая задержка между кортами
-
-        # Отправляем файл
-        file = FSInputFile(output_file)
-        await callback.bot.send_document(callback.message.chat.id, file, caption="📄 Полное расписание в Excel")
-
-        # Удаляем выходной файл после отправки
-        if os.path.exists(output_file):
-            os.remove(output_file)
-
-        # Очищаем временные файлы
-        cleanup_temp_files(data)
 
     except Exception as e:
         await callback.message.answer(f"❌ Ошибка при генерации: {str(e)}")
-        # Очищаем временные файлы в случае ошибки
-        data = await state.get_data()
-        cleanup_temp_files(data)
 
     await start(callback.message, state)
 
 
 @dp.callback_query(F.data == "cancel_generation")
 async def cancel_generation(callback: types.CallbackQuery, state: FSMContext):
-    # Очищаем временные файлы
-    data = await state.get_data()
-    cleanup_temp_files(data)
-
     await callback.message.edit_text("❌ Генерация отменена.")
     await start(callback.message, state)
 
 
 # === Запуск ===
 async def main():
+    global bot, UPLOAD_CACHE, SCHEDULE_CACHE, VIEW_CACHE, WORKERS, EDITOR, OUTBOX
+    if not TOKEN:
+        raise ValueError("❌ Токен не найден! Создайте файл .env и добавьте TOKEN=your_bot_token")
+
+    bot = Bot(token=TOKEN)
+    UPLOAD_CACHE = ParsedUploadCache(UPLOAD_CACHE_SIZE)
+    SCHEDULE_CACHE = ScheduleResultCache(SCHEDULE_CACHE_SIZE, cache_dir=SCHEDULE_CACHE_DIR)
+    VIEW_CACHE = ScheduleViewCache(VIEW_CACHE_SIZE, VIEW_CACHE_TTL)
+    WORKERS = WorkerPool(WORKER_PROCESSES, IO_THREADS, MAX_CONCURRENT_TASKS,
+                         timeout=GENERATION_TIMEOUT, io_timeout=IO_TIMEOUT)
+    EDITOR = WorkbookEditor(WORKERS.run_io, EDIT_WRITE_BEHIND)
+    OUTBOX = OutboundQueue(SEND_RATE, CHAT_SEND_RATE, CHAT_SEND_BURST, GROUP_SEND_RATE)
+
+    await bot.set_my_commands([
+        types.BotCommand(command="start", description="Главное меню"),
+        types.BotCommand(command="now", description="Что сейчас на кортах: /now [корт]"),
+        types.BotCommand(command="next", description="Следующие выступления: /next <корт> [N]"),
+        types.BotCommand(command="when", description="Когда выступает подгруппа: /when <подгруппа>"),
+    ])
+    # Процессы пула запускаются заранее: pandas импортируется до первой генерации
+    await WORKERS.warm_up()
     print("✅ Бот запущен!")
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        OUTBOX.close()
+        WORKERS.shutdown()
 
 
 if __name__ == "__main__":
@@ -1,27 +1,732 @@
+import bisect
+import functools
+import hashlib
+import heapq
+import io
+import json
+import os
+import pickle
+import random
+import re
+import sys
+import threading
+import time
+import numpy as np
 import pandas as pd
-from datetime import datetime, timedelta
-from typing import Dict, List, Tuple
-from dataclasses import dataclass
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from typing import BinaryIO, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+from dataclasses import dataclass, field, replace
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Border, Font, Side
 
+from data_processor import GroupRecord, normalize_group_name, records_from_dataframe
 
-@dataclass
+
+@dataclass(slots=True)
 class Stage:
     group_name: str
     subgroup_name: str
     stage_type: str
     participants: int
-    duration_minutes: float
-    exercises: List[str]
+    duration: int  # секунды
+    exercise: str
     stage_order: int
     group_id: str
+    heat: int = 0  # номер параллельного захода, 0 — этап не разделён
 
+    @property
+    def duration_minutes(self) -> float:
+        return self.duration / 60
 
-@dataclass
+    @property
+    def exercises(self) -> List[str]:
+        return [self.exercise]
+
+    @property
+    def stage_label(self) -> str:
+        return f"{self.stage_type} (заход {self.heat})" if self.heat else self.stage_type
+
+
+@dataclass(slots=True)
 class ScheduleSlot:
-    court: int  # 1, 2, 3
-    start_time: datetime
-    end_time: datetime
+    """Слот расписания. Время — целые секунды от полуночи первого дня соревнований;
+    datetime получается только при выводе через start_time / end_time."""
+    court: int  # 1..courts
+    start: int
+    end: int
     stage: Stage
+    event_day: datetime  # полночь первого дня, общая для всего расписания
+    venue: str = ""  # зал; пусто, если соревнования в одном зале
+    fixed_start: Optional[int] = None  # начало, заданное правкой: при пересчёте слот не ставится раньше
+
+    @property
+    def start_time(self) -> datetime:
+        return self.event_day + timedelta(seconds=self.start)
+
+    @property
+    def end_time(self) -> datetime:
+        return self.event_day + timedelta(seconds=self.end)
+
+
+@dataclass
+class ScheduleVariant:
+    """Вариант параметров для what_if; незаданные поля берутся из генератора"""
+    exercise_times: Dict[str, float] = field(default_factory=dict)  # только изменённые упражнения
+    start_time: Optional[str] = None  # ЧЧ:ММ
+    courts: Optional[int] = None
+    label: str = ""
+
+
+@dataclass
+class VariantResult:
+    variant: ScheduleVariant
+    courts: int
+    start: int  # секунды от полуночи первого дня
+    end: int
+    court_load: Dict[int, float]  # занятость корта, мин
+    idle_minutes: float  # суммарный простой кортов от начала до окончания, мин
+
+    @property
+    def total_minutes(self) -> float:
+        return (self.end - self.start) / 60
+
+
+@dataclass(frozen=True)
+class BlockedInterval:
+    start: float  # минуты от полуночи первого дня соревнований
+    end: float
+    label: str = "Перерыв"
+
+    @staticmethod
+    def format_minutes(minutes: float) -> str:
+        minutes = int(round(minutes)) % (24 * 60)
+        return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+    @property
+    def time_range(self) -> str:
+        return f"{self.format_minutes(self.start)} - {self.format_minutes(self.end)}"
+
+
+class ScheduleCalendar:
+    """Календарь запрещённых интервалов: обеды, церемонии, награждения, закрытие зала, ночи между днями.
+
+    Интервалы задаются в минутах от полуночи первого дня, поэтому календарь не зависит
+    от даты и поддерживает многодневные соревнования. Запросы планировщика — в целых секундах.
+    """
+
+    DAY = 24 * 60
+    SPEC_RE = re.compile(r"^(?:(\d+)\s+)?(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})(?:\s+(.+))?$")
+
+    def __init__(self, intervals: Iterable[BlockedInterval] = ()):
+        self.intervals = sorted((i for i in intervals if i.end > i.start), key=lambda i: (i.start, i.end))
+        self._interval_starts = [self.to_seconds(i.start) for i in self.intervals]
+
+        # Объединённые интервалы (в секундах) для поиска допустимого начала
+        merged: List[List[int]] = []
+        for interval in self.intervals:
+            start, end = self.to_seconds(interval.start), self.to_seconds(interval.end)
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        self._starts = [start for start, _ in merged]
+        self._ends = [end for _, end in merged]
+
+    @staticmethod
+    def to_seconds(minutes: float) -> int:
+        return int(round(minutes * 60))
+
+    @classmethod
+    def parse(cls, spec: str) -> "ScheduleCalendar":
+        """Разбирает строки вида "[день] ЧЧ:ММ-ЧЧ:ММ [название]", разделённые переводом строки или ';'.
+
+        День считается с 1; интервал, у которого конец раньше начала, переходит через полночь.
+        """
+        intervals = []
+        for line in re.split(r"[;\n]", spec):
+            line = line.strip()
+            if not line:
+                continue
+            match = cls.SPEC_RE.match(line)
+            if not match:
+                raise ValueError(f"Не удалось разобрать перерыв: {line}")
+            day, h1, m1, h2, m2, label = match.groups()
+            offset = (int(day or 1) - 1) * cls.DAY
+            start = offset + int(h1) * 60 + int(m1)
+            end = offset + int(h2) * 60 + int(m2)
+            if end <= start:
+                end += cls.DAY
+            intervals.append(BlockedInterval(start, end, (label or "Перерыв").strip()))
+        return cls(intervals)
+
+    def next_blocked_start(self, moment: int) -> float:
+        """Начало ближайшего интервала, который ещё не закончился к moment"""
+        i = bisect.bisect_right(self._ends, moment)
+        return self._starts[i] if i < len(self._starts) else float('inf')
+
+    def next_feasible_start(self, start: int, duration: int) -> int:
+        """Самое раннее начало не раньше start, при котором [начало, начало + duration) не пересекает интервалы"""
+        i = bisect.bisect_right(self._ends, start)
+        while i < len(self._starts) and self._starts[i] < start + duration:
+            start = max(start, self._ends[i])
+            i += 1
+        return start
+
+    def intervals_between(self, start: int, end: int) -> List[BlockedInterval]:
+        """Интервалы, начинающиеся в [start, end)"""
+        lo = bisect.bisect_left(self._interval_starts, start)
+        hi = bisect.bisect_left(self._interval_starts, end)
+        return self.intervals[lo:hi]
+
+    def blocked_between(self, start: int, end: int) -> int:
+        """Сколько секунд из [start, end) приходится на интервалы"""
+        total = 0
+        i = bisect.bisect_right(self._ends, start)
+        while i < len(self._starts) and self._starts[i] < end:
+            total += min(end, self._ends[i]) - max(start, self._starts[i])
+            i += 1
+        return total
+
+    def advance(self, start: int, work: int) -> int:
+        """Самый ранний момент, к которому начиная со start набирается work секунд вне интервалов"""
+        current = start
+        i = bisect.bisect_right(self._ends, start)
+        while i < len(self._starts):
+            if self._starts[i] > current:
+                window = self._starts[i] - current
+                if work <= window:
+                    break
+                work -= window
+            current = max(current, self._ends[i])
+            i += 1
+        return current + work
+
+    @classmethod
+    def format_offset(cls, seconds: int) -> str:
+        """ЧЧ:ММ, для следующих дней — с пометкой +Nд"""
+        text = BlockedInterval.format_minutes(seconds / 60)
+        days = int(seconds // (cls.DAY * 60))
+        return f"{text} +{days}д" if days else text
+
+
+@dataclass
+class CourtStatistics:
+    court: int
+    slots: int
+    busy_minutes: float
+    idle_minutes: float  # от начала расписания до окончания последнего корта
+    break_idle_minutes: float  # часть простоя из-за перерывов календаря
+    venue: str = ""
+
+    @property
+    def label(self) -> str:
+        return f"{self.venue}, корт {self.court}" if self.venue else f"Корт {self.court}"
+
+    @property
+    def utilization(self) -> float:
+        total = self.busy_minutes + self.idle_minutes
+        return self.busy_minutes / total if total else 0.0
+
+
+@dataclass
+class ScheduleStatistics:
+    start: int  # секунды от полуночи первого дня
+    end: int
+    lower_bound: int  # раньше этого времени расписание закончиться не может
+    courts: List[CourtStatistics]
+    critical_path: List[ScheduleSlot]  # цепочка слотов, определяющая окончание
+
+    @property
+    def makespan_minutes(self) -> float:
+        return (self.end - self.start) / 60
+
+    @property
+    def gap_minutes(self) -> float:
+        return (self.end - self.lower_bound) / 60
+
+    @property
+    def utilization(self) -> float:
+        busy = sum(c.busy_minutes for c in self.courts)
+        total = busy + sum(c.idle_minutes for c in self.courts)
+        return busy / total if total else 0.0
+
+    @property
+    def critical_groups(self) -> List[str]:
+        groups = []
+        for slot in self.critical_path:
+            name = f"{slot.stage.group_name} {slot.stage.subgroup_name}"
+            if not groups or groups[-1] != name:
+                groups.append(name)
+        return groups
+
+    def format_text(self) -> str:
+        lines = []
+        for c in self.courts:
+            line = (f"• {c.label}: {c.slots} выступлений, занят {c.busy_minutes:.0f} мин, "
+                    f"простой {c.idle_minutes:.0f} мин")
+            if c.break_idle_minutes:
+                line += f" (перерывы {c.break_idle_minutes:.0f})"
+            lines.append(line + f", загрузка {c.utilization:.0%}")
+        lines.append(f"• Загрузка кортов: {self.utilization:.0%}")
+        lines.append(
+            f"• Окончание: {ScheduleCalendar.format_offset(self.end)}, нижняя оценка "
+            f"{ScheduleCalendar.format_offset(self.lower_bound)} (+{self.gap_minutes:.0f} мин)"
+        )
+        if self.critical_path:
+            lines.append(f"• Окончание определяет: {' → '.join(self.critical_groups[-3:])}")
+        return "\n".join(lines)
+
+
+@dataclass
+class ScheduleResult:
+    """Готовый результат генерации: слоты, тексты по кортам, Excel и статистика"""
+    schedule: List[ScheduleSlot]
+    court_messages: Dict  # готовые к отправке части текста по кортам; для нескольких залов ключ — (зал, корт)
+    excel_bytes: bytes
+    backfilled_minutes: float = 0.0
+    statistics: Optional[ScheduleStatistics] = None
+    view_index: Optional["ScheduleViewIndex"] = None  # группа -> подгруппа -> выступления для просмотра
+
+    SLOT_SIZE = 300  # примерный объём слота вместе с этапом и записью индекса просмотра, байт
+    FORMAT_VERSION = 6  # меняется вместе с полями, чтобы не читать с диска записи старого вида
+
+    @property
+    def size(self) -> int:
+        text_size = sum(len(text) for messages in self.court_messages.values() for text in messages)
+        return len(self.excel_bytes) + 2 * text_size + self.SLOT_SIZE * len(self.schedule)
+
+
+class ScheduleResultCache:
+    """LRU-кэш результатов генерации по отпечатку входных данных.
+
+    Ограничен числом записей и примерным объёмом в памяти; если задан cache_dir,
+    записи сохраняются и на диск и переживают перезапуск бота.
+    """
+
+    def __init__(self, max_entries: int = 16, max_bytes: int = 64 * 1024 * 1024, cache_dir: Optional[str] = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self._entries: "OrderedDict[str, ScheduleResult]" = OrderedDict()
+        self._bytes = 0
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def get(self, key: str) -> Optional[ScheduleResult]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            return entry
+
+        entry = self._load(key)
+        if entry is not None:
+            self._remember(key, entry)
+        return entry
+
+    def put(self, key: str, entry: ScheduleResult):
+        self._remember(key, entry)
+        self._save(key, entry)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _remember(self, key: str, entry: ScheduleResult):
+        if key in self._entries:
+            self._bytes -= self._entries.pop(key).size
+        self._entries[key] = entry
+        self._bytes += entry.size
+        # Последняя запись остаётся, даже если одна превышает лимит объёма
+        while len(self._entries) > 1 and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.size
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}-v{ScheduleResult.FORMAT_VERSION}.pkl")
+
+    def _load(self, key: str) -> Optional[ScheduleResult]:
+        if not self.cache_dir or not os.path.exists(self._path(key)):
+            return None
+        try:
+            with open(self._path(key), 'rb') as f:
+                entry = pickle.load(f)
+            os.utime(self._path(key))  # для вытеснения давно не используемых файлов
+            return entry
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError) as e:
+            print(f"Не удалось прочитать кэш расписания {key}: {e}")
+            return None
+
+    def _save(self, key: str, entry: ScheduleResult):
+        if not self.cache_dir:
+            return
+        try:
+            tmp_path = self._path(key) + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._path(key))
+
+            files = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir) if name.endswith('.pkl')]
+            files.sort(key=os.path.getmtime)
+            for path in files[:max(0, len(files) - self.max_entries)]:
+                os.remove(path)
+        except OSError as e:
+            print(f"Не удалось сохранить кэш расписания {key}: {e}")
+
+
+class ScheduleIndex:
+    """Индекс готового расписания для вопросов «что сейчас на корте» и «когда выступает подгруппа».
+
+    Строится один раз: слоты каждого корта и каждой подгруппы отсортированы по началу,
+    запросы — бинарный поиск. Время — секунды от полуночи первого дня (см. offset).
+    Корт определяется парой (зал, номер); для расписания одного зала зал — пустая строка.
+    """
+
+    def __init__(self, schedule: List[ScheduleSlot]):
+        slots = sorted(schedule, key=lambda x: (x.start, x.venue, x.court))
+        self.event_day = slots[0].event_day if slots else None
+        self._courts: Dict[Tuple[str, int], List[ScheduleSlot]] = {}
+        # Подгруппа ищется по нормализованному названию, в разных группах оно может повторяться:
+        # название -> группа -> слоты этой подгруппы
+        self._subgroups: Dict[str, Dict[str, List[ScheduleSlot]]] = {}
+        for slot in slots:
+            self._courts.setdefault((slot.venue, slot.court), []).append(slot)
+            self._subgroups.setdefault(normalize_group_name(slot.stage.subgroup_name), {}) \
+                .setdefault(slot.stage.group_name, []).append(slot)
+
+        self._court_starts = {court: [s.start for s in court_slots] for court, court_slots in self._courts.items()}
+        # Самое позднее окончание среди слотов корта до i-го включительно: слоты одного корта
+        # не пересекаются, но индекс не должен на это полагаться
+        self._court_max_ends = {}
+        for court, court_slots in self._courts.items():
+            max_ends, latest = [], float('-inf')
+            for s in court_slots:
+                latest = max(latest, s.end)
+                max_ends.append(latest)
+            self._court_max_ends[court] = max_ends
+        # Для каждой подгруппы: начала слотов и самый длинный слот — насколько назад искать уже начавшийся
+        self._subgroup_starts: Dict[Tuple[str, str], List[int]] = {}
+        self._subgroup_longest: Dict[Tuple[str, str], int] = {}
+        for key, groups in self._subgroups.items():
+            for group, sub_slots in groups.items():
+                self._subgroup_starts[key, group] = [s.start for s in sub_slots]
+                self._subgroup_longest[key, group] = max(s.end - s.start for s in sub_slots)
+
+    @property
+    def courts(self) -> List[Tuple[str, int]]:
+        return sorted(self._courts)
+
+    @property
+    def schedule(self) -> List[ScheduleSlot]:
+        return sorted((slot for slots in self._courts.values() for slot in slots), key=lambda x: (x.start, x.venue, x.court))
+
+    def offset(self, moment: datetime) -> int:
+        return int((moment - self.event_day).total_seconds())
+
+    def current(self, court: int, moment: int, venue: str = "") -> Optional[ScheduleSlot]:
+        """Слот, идущий на корте в момент moment"""
+        key = (venue, court)
+        i = bisect.bisect_right(self._court_starts.get(key, []), moment) - 1
+        if i < 0 or self._court_max_ends[key][i] <= moment:
+            return None
+        slots = self._courts[key]
+        while slots[i].end <= moment:
+            i -= 1
+        return slots[i]
+
+    def upcoming(self, court: int, moment: int, count: int = 3, venue: str = "") -> List[ScheduleSlot]:
+        """Ближайшие count слотов корта, начинающихся после moment"""
+        i = bisect.bisect_right(self._court_starts.get((venue, court), []), moment)
+        return self._courts.get((venue, court), [])[i:i + count]
+
+    def next_for_subgroup(self, subgroup: str, moment: int) -> List[ScheduleSlot]:
+        """Ближайший ещё не закончившийся этап подгруппы (по одному на группу с таким названием подгруппы)"""
+        key = normalize_group_name(subgroup)
+        found = []
+        for group, slots in self._subgroups.get(key, {}).items():
+            # Уже начавшийся этап длится не дольше самого длинного, поэтому достаточно отступить на него;
+            # дальше просматриваются только слоты, начавшиеся в этом окне
+            i = bisect.bisect_left(self._subgroup_starts[key, group], moment - self._subgroup_longest[key, group])
+            while i < len(slots) and slots[i].end <= moment:
+                i += 1
+            if i < len(slots):
+                found.append(slots[i])
+        found.sort(key=lambda x: (x.start, x.venue, x.court))
+        return found
+
+
+@dataclass(slots=True)
+class StageView:
+    """Выступление, как оно записано в листе Excel расписания"""
+    sheet: str
+    row: int  # номер строки листа, заголовок — строка 1
+    time: str  # ЧЧ:ММ
+    stage: str
+    participants: Union[int, str]
+    poomse: str
+    date: str = ""  # ДД.ММ.ГГГГ, только в многодневном расписании
+    duration: float = 0.0  # минуты
+
+    @property
+    def order(self) -> Tuple[str, str]:
+        return self.date[6:] + self.date[3:5] + self.date[:2], self.time
+
+
+class ScheduleViewIndex:
+    """Группа -> подгруппа -> выступления по времени для просмотра расписания.
+
+    Строится из слотов при генерации (ScheduleGenerator.view_index) или одним проходом
+    по файлу Excel (from_workbook); шаги просмотра — поиск в словаре.
+    """
+
+    def __init__(self, entries: Iterable[Tuple[str, str, StageView]]):
+        self._groups: Dict[str, Dict[str, List[StageView]]] = {}
+        for group, subgroup, view in entries:
+            self._groups.setdefault(str(group), {}).setdefault(str(subgroup), []).append(view)
+        for subgroups in self._groups.values():
+            for views in subgroups.values():
+                views.sort(key=lambda view: view.order)
+        self.groups = sorted(self._groups)
+
+    def __contains__(self, group: str) -> bool:
+        return group in self._groups
+
+    def subgroups(self, group: str) -> List[str]:
+        return sorted(self._groups.get(group, {}))
+
+    def stages(self, group: str, subgroup: str) -> List[StageView]:
+        return self._groups.get(group, {}).get(subgroup, [])
+
+    @classmethod
+    def from_workbook(cls, source: Union[str, BinaryIO]) -> "ScheduleViewIndex":
+        """Индекс по листам кортов книги; листы без столбцов «Группа» и «Подгруппа» пропускаются"""
+        wb = load_workbook(source, read_only=True)
+        try:
+            return cls(list(cls._workbook_entries(wb)))
+        finally:
+            wb.close()
+
+    @staticmethod
+    def _workbook_entries(wb) -> Iterator[Tuple[str, str, StageView]]:
+        for ws in wb.worksheets:
+            rows = ws.iter_rows(values_only=True)
+            header = next(rows, None) or ()
+            column = {name: i for i, name in enumerate(header) if name is not None}
+            if 'Группа' not in column or 'Подгруппа' not in column:
+                continue
+
+            for row_number, row in enumerate(rows, 2):
+                def value(name: str, default=None):
+                    i = column.get(name)
+                    return row[i] if i is not None and i < len(row) and row[i] is not None else default
+
+                group, subgroup = value('Группа'), value('Подгруппа')
+                if group is None or subgroup is None:
+                    continue
+                yield group, subgroup, StageView(
+                    sheet=ws.title,
+                    row=row_number,
+                    time=str(value('Время', '—')),
+                    stage=str(value('Этап', '—')),
+                    participants=value('Участников', '—'),
+                    poomse=str(value('Пхумсе', '')),
+                    date=str(value('Дата', '')),
+                    duration=float(value('Длительность (мин)', 0))
+                )
+
+
+class ScheduleViewCache:
+    """Индексы просмотра по файлам расписаний пользователей.
+
+    Запись действительна, пока не изменилось время модификации файла; записей не больше
+    max_entries (LRU), не использованные дольше ttl секунд удаляются. При промахе индекс
+    строится по файлу. Кэш можно использовать из нескольких потоков.
+    """
+
+    def __init__(self, max_entries: int = 256, ttl: float = 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # путь -> (mtime файла, время последнего обращения, индекс)
+        self._entries: "OrderedDict[str, Tuple[int, float, ScheduleViewIndex]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path: str) -> Optional[ScheduleViewIndex]:
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            self.invalidate(path)
+            return None
+
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == mtime:
+                self._remember(path, mtime, entry[2], now)
+                return entry[2]
+
+        # Файл читается без блокировки, чтобы не задерживать обращения к другим файлам
+        try:
+            index = ScheduleViewIndex.from_workbook(path)
+        except Exception as e:
+            print(f"Ошибка при чтении расписания {path}: {e}")
+            return None
+        with self._lock:
+            self._remember(path, mtime, index, time.monotonic())
+        return index
+
+    def put(self, path: str, index: ScheduleViewIndex):
+        """Индекс только что записанного файла: следующий get не будет его перечитывать"""
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError as e:
+            print(f"Не удалось сохранить индекс расписания {path}: {e}")
+            return
+        with self._lock:
+            self._remember(path, mtime, index, time.monotonic())
+
+    def invalidate(self, path: str):
+        with self._lock:
+            self._entries.pop(path, None)
+
+    def _remember(self, path: str, mtime: int, index: ScheduleViewIndex, now: float):
+        self._entries[path] = (mtime, now, index)
+        self._entries.move_to_end(path)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _expire(self, now: float):
+        # Записи упорядочены по последнему обращению: устаревшие — в начале
+        while self._entries:
+            path, (_, accessed, _) = next(iter(self._entries.items()))
+            if now - accessed <= self.ttl:
+                break
+            del self._entries[path]
+
+
+class IncrementalRescheduler:
+    """Пересчёт готового расписания после правки одного слота.
+
+    Каждый слот начинается в самое раннее допустимое по календарю время не раньше начала
+    расписания, окончания предыдущего слота на корте, окончания предыдущего этапа группы
+    (плюс rest) и заданного вручную времени. После правки пересчитываются только слоты,
+    до которых доходят изменения; слоты меняются на месте, update возвращает сдвинувшиеся.
+    """
+
+    def __init__(self, schedule: List[ScheduleSlot], calendar: ScheduleCalendar, rest_minutes: float = 0):
+        self.calendar = calendar
+        self.rest = ScheduleCalendar.to_seconds(rest_minutes)
+        self.origin = min((slot.start for slot in schedule), default=0)
+
+        # Слоты каждого корта в порядке выступлений и позиция каждого слота в этом списке
+        self._courts: Dict[int, List[ScheduleSlot]] = {}
+        self._position: Dict[int, int] = {}
+        # Слоты группы по stage_order (параллельные заходы — на одном уровне)
+        self._levels: Dict[str, Dict[int, List[ScheduleSlot]]] = {}
+        self._orders: Dict[str, List[int]] = {}
+        for slot in sorted(schedule, key=lambda x: (x.start, x.court)):
+            self._courts.setdefault(slot.court, []).append(slot)
+            self._levels.setdefault(slot.stage.group_id, {}).setdefault(slot.stage.stage_order, []).append(slot)
+        for group_id, levels in self._levels.items():
+            self._orders[group_id] = sorted(levels)
+        for slots in self._courts.values():
+            self._reindex(slots)
+
+    @property
+    def schedule(self) -> List[ScheduleSlot]:
+        return sorted((slot for slots in self._courts.values() for slot in slots), key=lambda x: (x.start, x.court))
+
+    def update(self, slot: ScheduleSlot, duration: Optional[int] = None, start: Optional[int] = None,
+               court: Optional[int] = None) -> List[ScheduleSlot]:
+        """Меняет длительность (сек), время начала (сек от полуночи первого дня) или корт слота"""
+        before = (slot.court, slot.start, slot.end)
+        seeds = [slot]
+
+        if duration is not None:
+            slot.stage.duration = duration
+        if start is not None:
+            slot.fixed_start = start
+        if start is not None or (court is not None and court != slot.court):
+            # Слот переставляется: следующий за ним на старом месте может сдвинуться раньше
+            slots = self._courts[slot.court]
+            i = self._position[id(slot)]
+            if i + 1 < len(slots):
+                seeds.append(slots[i + 1])
+            del slots[i]
+            self._reindex(slots, i)
+            if court is not None:
+                slot.court = court
+            key = slot.start if start is None else self._clamp_key(slot, start)
+            slots = self._courts.setdefault(slot.court, [])
+            i = bisect.bisect_right(slots, key, key=lambda x: x.start)
+            slots.insert(i, slot)
+            self._reindex(slots, i)
+
+        moved = self._propagate(seeds)
+        if (slot.court, slot.start, slot.end) != before and all(s is not slot for s in moved):
+            moved.append(slot)
+        moved.sort(key=lambda x: (x.start, x.court))
+        return moved
+
+    def _clamp_key(self, slot: ScheduleSlot, key: int) -> int:
+        """Новое место слота на корте — между соседними этапами группы, иначе зависимости зациклятся"""
+        levels, orders = self._levels[slot.stage.group_id], self._orders[slot.stage.group_id]
+        level = bisect.bisect_left(orders, slot.stage.stage_order)
+        if level:
+            key = max(key, max(s.start for s in levels[orders[level - 1]]))
+        if level + 1 < len(orders):
+            key = min(key, min(s.start for s in levels[orders[level + 1]]) - 1)
+        return key
+
+    def _reindex(self, slots: List[ScheduleSlot], start: int = 0):
+        for i in range(start, len(slots)):
+            self._position[id(slots[i])] = i
+
+    def _earliest(self, slot: ScheduleSlot) -> int:
+        slots = self._courts[slot.court]
+        i = self._position[id(slot)]
+        earliest = max(self.origin, slot.fixed_start or 0, slots[i - 1].end if i else 0)
+
+        orders = self._orders[slot.stage.group_id]
+        level = bisect.bisect_left(orders, slot.stage.stage_order)
+        if level:
+            previous = self._levels[slot.stage.group_id][orders[level - 1]]
+            earliest = max(earliest, max(s.end for s in previous) + self.rest)
+        return earliest
+
+    def _successors(self, slot: ScheduleSlot) -> List[ScheduleSlot]:
+        successors = []
+        slots = self._courts[slot.court]
+        i = self._position[id(slot)]
+        if i + 1 < len(slots):
+            successors.append(slots[i + 1])
+
+        orders = self._orders[slot.stage.group_id]
+        level = bisect.bisect_right(orders, slot.stage.stage_order)
+        if level < len(orders):
+            successors.extend(self._levels[slot.stage.group_id][orders[level]])
+        return successors
+
+    def _propagate(self, seeds: List[ScheduleSlot]) -> List[ScheduleSlot]:
+        moved: Dict[int, ScheduleSlot] = {}
+        # Слоты обрабатываются по времени начала — в этом порядке идут все зависимости;
+        # дальше изменения идут только от слотов, которые действительно сдвинулись
+        queue = [(slot.start, i, slot, True) for i, slot in enumerate(seeds)]
+        heapq.heapify(queue)
+        seq = len(queue)
+        while queue:
+            _, _, slot, forced = heapq.heappop(queue)
+            start = self.calendar.next_feasible_start(self._earliest(slot), slot.stage.duration)
+            end = start + slot.stage.duration
+            if (start, end) != (slot.start, slot.end):
+                slot.start, slot.end = start, end
+                moved[id(slot)] = slot
+            elif not forced:
+                continue
+            for successor in self._successors(slot):
+                heapq.heappush(queue, (successor.start, seq, successor, False))
+                seq += 1
+        return list(moved.values())
 
 
 class ScheduleGenerator:
@@ -29,23 +734,85 @@ class ScheduleGenerator:
     LUNCH_START = 13 * 60  # 13:00 в минутах
     LUNCH_DURATION = 30  # минут
     LUNCH_TOLERANCE = 30  # ±30 минут от 13:00
-
-    def __init__(self, processed_data_file: str):
-        self.processed_data_file = processed_data_file
+    LUNCH_LABEL = "ОБЕД"
+    OPTIMIZE_TIME_BUDGET = 2.0  # секунд на оптимизирующий режим
+    OPTIMIZE_MAX_STALE = 5000  # итераций без улучшения до остановки
+    MODES = ("greedy", "optimize", "stages")
+    DEFAULT_REST_MINUTES = 10  # отдых спортсменов между этапами в режиме "stages"
+    HEAT_SIZE = 19  # участников в заходе отбора (больше — этап удлиняется)
+    SEMIFINAL_HEAT_SIZE = 8  # участников в заходе полуфинала
+    DEFAULT_COURTS = 3
+    MAX_COURTS = 32
+    DAY_SECONDS = 24 * 3600
+    STATISTICS_SHEET = 'Статистика'
+    SHEET_NAME_LIMIT = 31
+    SHEET_NAME_INVALID = re.compile(r"[\[\]:*?/\\]")
+    EXCEL_COLUMNS = ('Время', 'Группа', 'Подгруппа', 'Этап', 'Участников', 'Длительность (мин)', 'Окончание', 'Пхумсе')
+    TELEGRAM_MESSAGE_LIMIT = 4000  # лимит Telegram 4096 символов, оставляем запас
+    MARKDOWN_SPECIAL = re.compile(r"([_*`\[])")
+
+    def __init__(self, processed_data: Union[str, pd.DataFrame, List[GroupRecord]],
+                 courts: int = DEFAULT_COURTS, calendar: Optional[ScheduleCalendar] = None,
+                 backfill: bool = True, rest_minutes: float = DEFAULT_REST_MINUTES,
+                 final_court: Optional[int] = None, parallel_heats: bool = True,
+                 split_semifinals: bool = False, venue: str = ""):
+        # Принимает путь к обработанному файлу, промежуточный DataFrame
+        # или готовый список записей групп из DataProcessor
+        if not 1 <= courts <= self.MAX_COURTS:
+            raise ValueError(f"Количество кортов должно быть от 1 до {self.MAX_COURTS}")
+        if final_court is not None and not 1 <= final_court <= courts:
+            raise ValueError(f"Корт для финалов должен быть от 1 до {courts}")
+        self.courts = courts
+        # Название зала: записывается в слоты и добавляется к заголовкам кортов и листам Excel
+        self.venue = venue
+        # Для режима "stages": минимальный отдых между этапами группы и отдельный корт для финалов
+        self.rest_minutes = rest_minutes
+        self.final_court = final_court
+        # Там же: разбиение большого отбора (и, по желанию, полуфинала) на параллельные заходы
+        self.parallel_heats = parallel_heats
+        self.split_semifinals = split_semifinals
+        # По умолчанию — один обед в первый день: 12:30 - 14:00 (13:00 ±30 мин + 30 мин)
+        self.calendar = calendar or self.default_calendar()
+        # Полночь первого дня: нужна только для перевода секунд в datetime при выводе
+        self.event_day: Optional[datetime] = None
+        self.mode: Optional[str] = None  # режим последнего generate_schedule
+        # Дозаполнение простоя перед перерывами короткими группами
+        self.backfill = backfill
+        self.backfilled_minutes = 0.0
+        self.processed_data_file = processed_data if isinstance(processed_data, str) else None
         self.exercise_times: Dict[str, float] = {}
+        self._records: Optional[List[GroupRecord]] = None
+
+        if isinstance(processed_data, pd.DataFrame):
+            self._records = records_from_dataframe(processed_data)
+        elif not isinstance(processed_data, str):
+            self._records = list(processed_data)
+
+    @classmethod
+    def default_calendar(cls) -> ScheduleCalendar:
+        return ScheduleCalendar([BlockedInterval(
+            cls.LUNCH_START - cls.LUNCH_TOLERANCE,
+            cls.LUNCH_START + cls.LUNCH_TOLERANCE + cls.LUNCH_DURATION,
+            cls.LUNCH_LABEL
+        )])
+
+    @property
+    def court_numbers(self) -> range:
+        return range(1, self.courts + 1)
+
+    def get_group_records(self) -> List[GroupRecord]:
+        # Файл читается не более одного раза на генератор
+        if self._records is None:
+            df = pd.read_excel(self.processed_data_file, header=None)
+            self._records = records_from_dataframe(df)
+        return self._records
 
     def get_unique_exercises(self) -> List[str]:
-        df = pd.read_excel(self.processed_data_file, header=None)
-
         exercises = set()
-        # Проходим по столбцам 3, 4, 5 (отбор, полуф, финал)
-        for col in [3, 4, 5]:
-            if df.shape[1] > col:
-                for val in df.iloc[:, col]:
-                    if pd.notna(val) and isinstance(val, str):
-                        val = val.strip()
-                        if val and val.lower() != 'nan':
-                            exercises.add(val)
+        for record in self.get_group_records():
+            for val in (record.otbor, record.polufinal, record.final):
+                if val and val.lower() != 'nan':
+                    exercises.add(val)
 
         return sorted(list(exercises))
 
@@ -65,27 +832,48 @@ class ScheduleGenerator:
 
         return duration
 
+    def stage_duration(self, stage: Stage, participants: int) -> int:
+        """Длительность этапа (сек) при другом числе участников — с тем же временем упражнения,
+        что заложено в текущей длительности (название упражнения могло быть изменено вручную)"""
+        per_exercise = self.calculate_stage_duration(stage.participants, 1) - self.BREAK_BETWEEN_GROUPS
+        exercise_time = (stage.duration / 60 - self.BREAK_BETWEEN_GROUPS) / per_exercise if per_exercise else 0
+        return self._to_seconds(self.calculate_stage_duration(participants, max(exercise_time, 0)))
+
     def create_stages_for_group(self, group_name: str, subgroup_name: str,
                                 initial_participants: int,
-                                otbor_exercise: str, polufinal_exercise: str, final_exercise: str) -> List[Stage]:
+                                otbor_exercise: str, polufinal_exercise: str, final_exercise: str,
+                                split_heats: bool = False) -> List[Stage]:
         stages = []
-        group_id = f"{group_name}_{subgroup_name}"
+        # Строки интернируются: у тысяч этапов одни и те же названия
+        group_name, subgroup_name = sys.intern(group_name), sys.intern(subgroup_name)
+        group_id = sys.intern(f"{group_name}_{subgroup_name}")
         stage_order = 1
 
-        if initial_participants > 19:
-            if otbor_exercise:
-                exercise_time = self.exercise_times.get(otbor_exercise, 0)
-                duration = self.calculate_stage_duration(initial_participants, exercise_time)
+        def add_stage(stage_type: str, participants: int, exercise: str, heat_size: Optional[int]):
+            # При split_heats этап делится на заходы по heat_size участников, не больше числа кортов
+            heats = 1
+            if split_heats and heat_size:
+                heats = min(-(-participants // heat_size), self.courts)
+
+            exercise = sys.intern(exercise)
+            exercise_time = self.exercise_times.get(exercise, 0)
+            for heat in range(heats):
+                heat_participants = participants // heats + (1 if heat < participants % heats else 0)
                 stages.append(Stage(
                     group_name=group_name,
                     subgroup_name=subgroup_name,
-                    stage_type="отбор",
-                    participants=initial_participants,
-                    duration_minutes=duration,
-                    exercises=[otbor_exercise],
+                    stage_type=stage_type,
+                    participants=heat_participants,
+                    duration=self._to_seconds(self.calculate_stage_duration(heat_participants, exercise_time)),
+                    exercise=exercise,
                     stage_order=stage_order,
-                    group_id=group_id
+                    group_id=group_id,
+                    heat=heat + 1 if heats > 1 else 0
                 ))
+
+        if initial_participants > 19:
+            if otbor_exercise:
+                add_stage("отбор", initial_participants, otbor_exercise, self.HEAT_SIZE)
                 stage_order += 1
 
             # После отбора остается 19 участников
@@ -96,18 +884,8 @@ class ScheduleGenerator:
         if current_participants > 8:
             # Полуфинал - используем упражнение для полуфинала
             if polufinal_exercise:
-                exercise_time = self.exercise_times.get(polufinal_exercise, 0)
-                duration = self.calculate_stage_duration(current_participants, exercise_time)
-                stages.append(Stage(
-                    group_name=group_name,
-                    subgroup_name=subgroup_name,
-                    stage_type="полуфинал",
-                    participants=current_participants,
-                    duration_minutes=duration,
-                    exercises=[polufinal_exercise],
-                    stage_order=stage_order,
-                    group_id=group_id
-                ))
+                add_stage("полуфинал", current_participants, polufinal_exercise,
+                          self.SEMIFINAL_HEAT_SIZE if self.split_semifinals else None)
                 stage_order += 1
 
             # После полуфинала остается 8 участников
@@ -115,74 +893,85 @@ class ScheduleGenerator:
 
         # Финал (всегда есть) - используем упражнение для финала
         if final_exercise:
-            exercise_time = self.exercise_times.get(final_exercise, 0)
-            duration = self.calculate_stage_duration(current_participants, exercise_time)
-            stages.append(Stage(
-                group_name=group_name,
-                subgroup_name=subgroup_name,
-                stage_type="финал",
-                participants=current_participants,
-                duration_minutes=duration,
-                exercises=[final_exercise],
-                stage_order=stage_order,
-                group_id=group_id
-            ))
+            add_stage("финал", current_participants, final_exercise, None)
 
         return stages
 
-    def load_all_stages(self) -> List[Stage]:
-        df = pd.read_excel(self.processed_data_file, header=None)
-
+    def load_all_stages(self, split_heats: bool = False) -> List[Stage]:
         all_stages = []
 
-        # Проходим по всем строкам (первая строка может быть заголовком, но мы её пропустим по условиям)
-        for idx in range(len(df)):
-            # Проверяем наличие данных в строке
-            if df.shape[1] > 2 and pd.notna(df.iloc[idx, 0]) and pd.notna(df.iloc[idx, 1]):
-                group_name = str(df.iloc[idx, 0]).strip()
-                subgroup_name = str(df.iloc[idx, 1]).strip()
+        for record in self.get_group_records():
+            # Подгруппы без названия и без участников не планируются
+            if not record.subgroup or record.participants <= 0:
+                continue
 
-                # Пропускаем заголовки
-                if 'наименование группы' in group_name.lower() or 'подгруппа' in subgroup_name.lower():
-                    continue
+            # Создаем этапы для группы
+            stages = self.create_stages_for_group(
+                record.group_name, record.subgroup, record.participants,
+                record.otbor, record.polufinal, record.final,
+                split_heats=split_heats
+            )
+            all_stages.extend(stages)
 
-                # Получаем количество участников
-                participants = df.iloc[idx, 2] if df.shape[1] > 2 else 0
-                if pd.isna(participants):
-                    continue
+        return all_stages
 
-                try:
-                    participants = int(float(participants))
-                except (ValueError, TypeError):
-                    continue
+    def distribute_to_courts(self, stages: List[Stage], start_time: Union[int, datetime]) -> List[ScheduleSlot]:
+        start = self._start_seconds(start_time)
+        groups_stages = self._group_stages(stages)
 
-                if participants <= 0:
-                    continue
+        # Куча кортов (время окончания последнего выступления, номер корта):
+        # выбор самого свободного корта за O(log C), при равенстве — корт с меньшим номером
+        court_heap = [(start, court) for court in self.court_numbers]
+        heapq.heapify(court_heap)
+        court_schedules = {court: [] for court in self.court_numbers}
 
-                # Получаем упражнения для этапов
-                otbor_exercise = ''
-                polufinal_exercise = ''
-                final_exercise = ''
+        # Сортируем группы по общей длительности (самые длинные первые)
+        group_durations = {
+            group_id: sum(s.duration for s in group_stages)
+            for group_id, group_stages in groups_stages.items()
+        }
+        sorted_groups = sorted(
+            groups_stages.items(),
+            key=lambda x: group_durations[x[0]],
+            reverse=True
+        )
 
-                if df.shape[1] > 3 and pd.notna(df.iloc[idx, 3]):
-                    otbor_exercise = str(df.iloc[idx, 3]).strip()
+        # Ещё не размещённые группы по возрастанию длительности — для дозаполнения простоя перед перерывами
+        remaining = sorted((group_durations[group_id], i, group_id) for i, (group_id, _) in enumerate(sorted_groups))
+        self.backfilled_minutes = 0.0
 
-                if df.shape[1] > 4 and pd.notna(df.iloc[idx, 4]):
-                    polufinal_exercise = str(df.iloc[idx, 4]).strip()
+        # Распределяем этапы
+        for i, (group_id, group_stages) in enumerate(sorted_groups):
+            entry = (group_durations[group_id], i, group_id)
+            pos = bisect.bisect_left(remaining, entry)
+            if pos == len(remaining) or remaining[pos] != entry:
+                continue  # группа уже поставлена в простой перед перерывом
+            remaining.pop(pos)
+
+            # Первый этап - на корт с наименьшим временем окончания,
+            # последующие - на том же корте сразу после предыдущего этапа
+            court_end, available_court = heapq.heappop(court_heap)
+
+            if self.backfill:
+                court_end = self._backfill_before_break(
+                    court_end, group_stages[0].duration, available_court,
+                    remaining, groups_stages, court_schedules
+                )
 
-                if df.shape[1] > 5 and pd.notna(df.iloc[idx, 5]):
-                    final_exercise = str(df.iloc[idx, 5]).strip()
+            court_end = self._place_group(group_stages, available_court, court_end, court_schedules)
+            heapq.heappush(court_heap, (court_end, available_court))
 
-                # Создаем этапы для группы
-                stages = self.create_stages_for_group(
-                    group_name, subgroup_name, participants,
-                    otbor_exercise, polufinal_exercise, final_exercise
-                )
-                all_stages.extend(stages)
+        # Объединяем все слоты и сортируем по времени и корту
+        all_slots = []
+        for court, slots in court_schedules.items():
+            all_slots.extend(slots)
 
-        return all_stages
+        all_slots.sort(key=lambda x: (x.start, x.court))
+
+        return all_slots
 
-    def distribute_to_courts(self, stages: List[Stage], start_time: datetime) -> List[ScheduleSlot]:
+    @staticmethod
+    def _group_stages(stages: List[Stage]) -> Dict[str, List[Stage]]:
         groups_stages: Dict[str, List[Stage]] = {}
         for stage in stages:
             if stage.group_id not in groups_stages:
@@ -193,199 +982,1119 @@ class ScheduleGenerator:
         for group_id in groups_stages:
             groups_stages[group_id].sort(key=lambda s: s.stage_order)
 
-        # Инициализируем корты (время окончания последнего выступления)
-        court_end_times = {1: start_time, 2: start_time, 3: start_time}
-        court_schedules = {1: [], 2: [], 3: []}
+        return groups_stages
+
+    def distribute_stages_across_courts(self, stages: List[Stage],
+                                        start_time: Union[int, datetime]) -> List[ScheduleSlot]:
+        """Размещение по этапам: любой этап может идти на любом корте.
+
+        Этап начинается не раньше окончания предыдущего этапа группы плюс rest_minutes;
+        параллельные заходы одного этапа (одинаковый stage_order) идут независимо,
+        а следующий этап ждёт окончания всех заходов.
+        Освободившийся корт берёт из готовых к этому моменту этапов тот, у группы которого
+        самый длинный остаток цепочки. Если задан final_court, финалы идут только на него,
+        а остальные этапы — на другие корты.
+        """
+        start = self._start_seconds(start_time)
+        groups_stages = self._group_stages(stages)
+        rest = self._to_seconds(self.rest_minutes)
+        self.backfilled_minutes = 0.0
+
+        def stage_class(stage: Stage) -> str:
+            return "final" if self.final_court is not None and stage.stage_type == "финал" else "other"
+
+        court_classes = {}
+        for court in self.court_numbers:
+            if self.final_court is None or self.courts == 1:
+                court_classes[court] = ("final", "other")
+            else:
+                court_classes[court] = ("final",) if court == self.final_court else ("other",)
+
+        # Уровни группы — индексы этапов с одинаковым stage_order (заходы идут параллельно)
+        levels: Dict[str, List[List[int]]] = {}
+        level_of: Dict[Tuple[str, int], int] = {}
+        for group_id, group_stages in groups_stages.items():
+            group_levels = levels[group_id] = []
+            for idx, stage in enumerate(group_stages):
+                if not group_levels or group_stages[group_levels[-1][0]].stage_order != stage.stage_order:
+                    group_levels.append([])
+                group_levels[-1].append(idx)
+                level_of[group_id, idx] = len(group_levels) - 1
+
+        # Остаток цепочки группы от каждого уровня — приоритет среди готовых этапов
+        tails: Dict[str, List[int]] = {}
+        for group_id, group_levels in levels.items():
+            tail, group_tails = 0, []
+            for level in reversed(group_levels):
+                tail += max(groups_stages[group_id][idx].duration for idx in level)
+                group_tails.append(tail)
+            tails[group_id] = group_tails[::-1]
+
+        pending = {"final": [], "other": []}  # (время готовности, seq, группа, индекс этапа)
+        available = {"final": [], "other": []}  # (-остаток цепочки, seq, группа, индекс, время готовности)
+        # Незавершённые этапы текущего уровня группы и самое позднее окончание среди завершённых
+        level_left: Dict[str, int] = {}
+        level_end: Dict[str, int] = {}
+        for seq, group_id in enumerate(groups_stages):
+            level_left[group_id] = len(levels[group_id][0])
+            level_end[group_id] = start
+            for idx in levels[group_id][0]:
+                pending[stage_class(groups_stages[group_id][idx])].append((start, seq, group_id, idx))
+        for heap in pending.values():
+            heapq.heapify(heap)
+
+        # Корты по времени освобождения; корты без подходящих этапов ждут их появления
+        free = [(start, court) for court in self.court_numbers]
+        heapq.heapify(free)
+        waiting: Dict[int, int] = {}
 
-        # Отслеживаем последний запланированный этап для каждой группы
-        last_scheduled_stage: Dict[str, Tuple[int, datetime]] = {}  # group_id -> (court, end_time)
+        all_slots = []
+        while free:
+            court_time, court = heapq.heappop(free)
+            classes = court_classes[court]
+
+            for cls in classes:
+                while pending[cls] and pending[cls][0][0] <= court_time:
+                    ready_time, seq, group_id, idx = heapq.heappop(pending[cls])
+                    heapq.heappush(available[cls], (
+                        -tails[group_id][level_of[group_id, idx]], seq, group_id, idx, ready_time
+                    ))
+
+            candidates = [cls for cls in classes if available[cls]]
+            if not candidates:
+                # Нечего ставить: ждём ближайший готовый этап или пока не появятся новые
+                next_ready = [pending[cls][0][0] for cls in classes if pending[cls]]
+                if next_ready:
+                    heapq.heappush(free, (min(next_ready), court))
+                else:
+                    waiting[court] = court_time
+                continue
+
+            cls = min(candidates, key=lambda c: available[c][0])
+            entry = available[cls][0]
+            stage = groups_stages[entry[2]][entry[3]]
+
+            # Если этап уходит за перерыв, сначала пробуем занять окно до перерыва
+            # самым длинным из готовых этапов, который в него помещается
+            if self.backfill and self._adjust_for_breaks(court_time, stage.duration) != court_time:
+                window = self.calendar.next_blocked_start(court_time) - court_time
+                fitting = [
+                    (groups_stages[e[2]][e[3]].duration, c, e)
+                    for c in candidates for e in available[c]
+                    if groups_stages[e[2]][e[3]].duration <= window
+                ]
+                if fitting:
+                    duration, cls, entry = max(fitting, key=lambda x: (x[0], x[2]))
+                    self.backfilled_minutes += duration / 60
+
+            available[cls].remove(entry)
+            heapq.heapify(available[cls])
+            _, seq, group_id, idx, ready_time = entry
+            stage = groups_stages[group_id][idx]
+
+            stage_start = self._adjust_for_breaks(max(court_time, ready_time), stage.duration)
+            stage_end = stage_start + stage.duration
+            all_slots.append(ScheduleSlot(court, stage_start, stage_end, stage, self.event_day, self.venue))
+            heapq.heappush(free, (stage_end, court))
+
+            # Когда закончены все заходы уровня, становится готов следующий этап
+            level_left[group_id] -= 1
+            level_end[group_id] = max(level_end[group_id], stage_end)
+            next_level = level_of[group_id, idx] + 1
+            if level_left[group_id] == 0 and next_level < len(levels[group_id]):
+                ready_time = level_end[group_id] + rest
+                level_left[group_id] = len(levels[group_id][next_level])
+                for next_idx in levels[group_id][next_level]:
+                    next_class = stage_class(groups_stages[group_id][next_idx])
+                    heapq.heappush(pending[next_class], (ready_time, seq, group_id, next_idx))
+
+                    for waiting_court in [c for c in waiting if next_class in court_classes[c]]:
+                        heapq.heappush(free, (max(waiting.pop(waiting_court), ready_time), waiting_court))
+
+        if len(all_slots) < len(stages):
+            # Например, финалы при final_court, которого нет среди кортов
+            raise ValueError(f"Не удалось разместить {len(stages) - len(all_slots)} из {len(stages)} этапов")
+
+        all_slots.sort(key=lambda x: (x.start, x.court))
 
-        # Сортируем группы по общей длительности (самые длинные первые)
-        sorted_groups = sorted(
-            groups_stages.items(),
-            key=lambda x: sum(s.duration_minutes for s in x[1]),
-            reverse=True
-        )
+        return all_slots
 
-        # Распределяем этапы
-        for group_id, group_stages in sorted_groups:
+    def _place_group(self, group_stages: List[Stage], court: int, stage_start: int,
+                     court_schedules: Dict[int, List[ScheduleSlot]]) -> int:
+        """Ставит этапы группы подряд на корт, возвращает время окончания"""
+        for stage in group_stages:
+            # Проверяем, не попадает ли на перерыв
+            stage_start = self._adjust_for_breaks(stage_start, stage.duration)
+
+            stage_end = stage_start + stage.duration
+
+            # Создаем слот
+            court_schedules[court].append(ScheduleSlot(court, stage_start, stage_end, stage, self.event_day, self.venue))
+            stage_start = stage_end
+
+        return stage_start
+
+    def _backfill_before_break(self, court_end: int, next_duration: int, court: int,
+                               remaining: List[Tuple[int, int, str]],
+                               groups_stages: Dict[str, List[Stage]],
+                               court_schedules: Dict[int, List[ScheduleSlot]]) -> int:
+        """Заполняет простой корта перед перерывом целыми группами, которые успевают до его начала.
+
+        Если следующий этап переносится за перерыв, в окно до начала перерыва ставится самая
+        длинная подходящая группа (все её этапы подряд), и так пока что-то помещается.
+        """
+        while remaining and self._adjust_for_breaks(court_end, next_duration) != court_end:
+            window = self.calendar.next_blocked_start(court_end) - court_end
+
+            # Самая длинная группа, которая целиком помещается в окно
+            pos = bisect.bisect_right(remaining, (window, float('inf'), '')) - 1
+            if pos < 0:
+                break
+            duration, _, group_id = remaining.pop(pos)
+
+            court_end = self._place_group(groups_stages[group_id], court, court_end, court_schedules)
+            self.backfilled_minutes += duration / 60
+
+        return court_end
+
+    def distribute_to_courts_optimized(self, stages: List[Stage], start_time: Union[int, datetime],
+                                       time_budget: float = None, seed: int = 0) -> List[ScheduleSlot]:
+        """Локальный поиск поверх жадного распределения.
+
+        Решение — последовательность групп на каждом корте (этапы группы идут подряд,
+        обед учитывается при симуляции). Минимизируется время окончания, затем простой
+        из-за обеда. По истечении time_budget возвращается лучшее найденное решение.
+        """
+        if time_budget is None:
+            time_budget = self.OPTIMIZE_TIME_BUDGET
+        deadline = time.monotonic() + time_budget
+
+        start = self._start_seconds(start_time)
+        greedy = self.distribute_to_courts(stages, start)
+        sequences = self._court_sequences(greedy)
+        courts = sorted(sequences)
+        n_groups = sum(len(seq) for seq in sequences.values())
+        if len(courts) < 2 and n_groups < 2:
+            return greedy
+
+        # Нижняя оценка: ни один корт не закончит раньше средней загрузки и самой длинной группы
+        group_durations = [sum(s.duration for s in g) for seq in sequences.values() for g in seq]
+        lower_bound = start + max(sum(group_durations) / len(courts), max(group_durations))
+
+        court_costs = {court: self._simulate_court(sequences[court], start) for court in courts}
+
+        def total_cost(costs):
+            return (max(end for end, _ in costs.values()), sum(idle for _, idle in costs.values()))
+
+        current_cost = total_cost(court_costs)
+        best_cost = greedy_cost = current_cost
+        best_sequences = {court: list(seq) for court, seq in sequences.items()}
+        rng = random.Random(seed)
+        stale = 0
+
+        while time.monotonic() < deadline and stale < self.OPTIMIZE_MAX_STALE:
+            if best_cost[0] <= lower_bound and best_cost[1] == 0:
+                break
+
+            # Работаем с кортом, который определяет окончание
+            critical = max(courts, key=lambda c: court_costs[c][0])
+            if not sequences[critical]:
+                break
+            other = rng.choice(courts)
+
+            candidate = {critical: list(sequences[critical])}
+            if other != critical:
+                candidate[other] = list(sequences[other])
+            src, dst = candidate[critical], candidate[other]
+            i = rng.randrange(len(src))
+
+            move = rng.random()
+            if other != critical and (move < 0.5 or not dst):
+                # Перенос группы на другой корт
+                dst.insert(rng.randint(0, len(dst)), src.pop(i))
+            elif other != critical:
+                # Обмен группами между кортами
+                j = rng.randrange(len(dst))
+                src[i], dst[j] = dst[j], src[i]
+            elif len(src) > 1:
+                # Перестановка внутри корта (помогает обойти обед)
+                j = rng.randrange(len(src))
+                src.insert(j, src.pop(i))
+            else:
+                stale += 1
+                continue
+
+            new_costs = dict(court_costs)
+            for court, seq in candidate.items():
+                new_costs[court] = self._simulate_court(seq, start)
+            new_cost = total_cost(new_costs)
+
+            # Принимаем и равноценные ходы, чтобы выходить с плато
+            if new_cost <= current_cost:
+                sequences.update(candidate)
+                court_costs = new_costs
+                current_cost = new_cost
+
+            if new_cost < best_cost:
+                best_cost = new_cost
+                best_sequences = {court: list(seq) for court, seq in sequences.items()}
+                stale = 0
+            else:
+                stale += 1
+
+        if best_cost >= greedy_cost:
+            return greedy
+
+        # Оптимизированный план собран заново: жадное заполнение перед перерывами в нём не сохраняется
+        self.backfilled_minutes = 0.0
+        return self._slots_from_sequences(best_sequences, start)
+
+    def _court_sequences(self, schedule: List[ScheduleSlot]) -> Dict[int, List[List[Stage]]]:
+        """Восстанавливает последовательность групп на каждом корте из готового расписания"""
+        sequences: Dict[int, List[List[Stage]]] = {court: [] for court in self.court_numbers}
+        positions: Dict[str, List[Stage]] = {}
+        for slot in sorted(schedule, key=lambda x: (x.court, x.start)):
+            group_stages = positions.get(slot.stage.group_id)
+            if group_stages is None:
+                group_stages = positions[slot.stage.group_id] = []
+                sequences.setdefault(slot.court, []).append(group_stages)
+            group_stages.append(slot.stage)
+        return sequences
+
+    def _simulate_court(self, sequence: List[List[Stage]], start: int) -> Tuple[int, int]:
+        """Время окончания корта и простой из-за перерывов (сек) для заданного порядка групп"""
+        current = start
+        break_idle = 0
+        for group_stages in sequence:
             for stage in group_stages:
-                # Определяем, на каком корте должен быть этот этап
-                if stage.stage_order == 1:
-                    # Первый этап - выбираем корт с наименьшим временем окончания
-                    available_court = min(court_end_times.items(), key=lambda x: x[1])[0]
-                    stage_start = court_end_times[available_court]
-                else:
-                    # Последующие этапы - на том же корте после предыдущего этапа
-                    prev_court, prev_end = last_scheduled_stage[group_id]
-                    available_court = prev_court
-                    stage_start = prev_end
-
-                # Проверяем, не попадает ли на обед
-                stage_start = self._adjust_for_lunch(stage_start, stage.duration_minutes)
-
-                stage_end = stage_start + timedelta(minutes=stage.duration_minutes)
-
-                # Создаем слот
-                slot = ScheduleSlot(
-                    court=available_court,
-                    start_time=stage_start,
-                    end_time=stage_end,
-                    stage=stage
-                )
+                stage_start = self._adjust_for_breaks(current, stage.duration)
+                break_idle += stage_start - current
+                current = stage_start + stage.duration
+        return current, break_idle
 
-                court_schedules[available_court].append(slot)
-                court_end_times[available_court] = stage_end
-                last_scheduled_stage[group_id] = (available_court, stage_end)
-
-        # Объединяем все слоты и сортируем по времени и корту
+    def _slots_from_sequences(self, sequences: Dict[int, List[List[Stage]]],
+                              start: int) -> List[ScheduleSlot]:
         all_slots = []
-        for court, slots in court_schedules.items():
-            all_slots.extend(slots)
+        for court, sequence in sequences.items():
+            current = start
+            for group_stages in sequence:
+                for stage in group_stages:
+                    stage_start = self._adjust_for_breaks(current, stage.duration)
+                    current = stage_start + stage.duration
+                    all_slots.append(ScheduleSlot(court, stage_start, current, stage, self.event_day, self.venue))
 
-        all_slots.sort(key=lambda x: (x.start_time, x.court))
+        all_slots.sort(key=lambda x: (x.start, x.court))
 
         return all_slots
 
-    def _adjust_for_lunch(self, start_time: datetime, duration_minutes: float) -> datetime:
-        lunch_start_min = self.LUNCH_START - self.LUNCH_TOLERANCE  # 12:30
-        lunch_end_min = self.LUNCH_START + self.LUNCH_TOLERANCE + self.LUNCH_DURATION  # 13:60 = 14:00
-
-        start_minutes = start_time.hour * 60 + start_time.minute
-        end_minutes = start_minutes + duration_minutes
-
-        # Если выступление попадает на обед, переносим после обеда
-        if start_minutes < lunch_end_min and end_minutes > lunch_start_min:
-            # Переносим на время после обеда
-            new_start_minutes = lunch_end_min
-            new_start_time = start_time.replace(
-                hour=new_start_minutes // 60,
-                minute=new_start_minutes % 60,
-                second=0
-            )
-            return new_start_time
-
+    @staticmethod
+    def _to_seconds(minutes: float) -> int:
+        return int(round(minutes * 60))
+
+    def _start_seconds(self, start_time: Union[int, datetime]) -> int:
+        """Секунды от полуночи первого дня; datetime задаёт и сам день"""
+        if isinstance(start_time, datetime):
+            self.event_day = datetime.combine(start_time.date(), datetime.min.time())
+            return start_time.hour * 3600 + start_time.minute * 60 + start_time.second
+        if self.event_day is None:
+            self.event_day = datetime.combine(date.today(), datetime.min.time())
         return start_time
 
-    def generate_schedule(self, start_time_str: str) -> List[ScheduleSlot]:
-        # Парсим время начала
+    def _to_datetime(self, seconds: int, event_day: datetime = None) -> datetime:
+        return (event_day or self.event_day) + timedelta(seconds=seconds)
+
+    def _adjust_for_breaks(self, start: int, duration: int) -> int:
+        # Если выступление попадает на перерыв, переносим на ближайшее допустимое время
+        return self.calendar.next_feasible_start(start, duration)
+
+    def fingerprint(self, start_time_str: str, mode: str = "greedy", event_date: Optional[date] = None) -> str:
+        """Стабильный хеш всех входных данных generate_schedule — ключ кэша результатов"""
+        payload = {
+            'records': [
+                [r.group_name, r.subgroup, r.participants, r.otbor, r.polufinal, r.final]
+                for r in self.get_group_records()
+            ],
+            'exercise_times': sorted(self.exercise_times.items()),
+            'calendar': [[i.start, i.end, i.label] for i in self.calendar.intervals],
+            'courts': self.courts,
+            'backfill': self.backfill,
+            'rest_minutes': self.rest_minutes,
+            'final_court': self.final_court,
+            'parallel_heats': self.parallel_heats,
+            'split_semifinals': self.split_semifinals,
+            'start_time': start_time_str,
+            'mode': mode,
+            'event_date': (event_date or date.today()).isoformat(),
+        }
+        encoded = json.dumps(payload, ensure_ascii=False, sort_keys=True, default=str).encode('utf-8')
+        return hashlib.sha256(encoded).hexdigest()
+
+    def rescheduler(self, schedule: List[ScheduleSlot]) -> IncrementalRescheduler:
+        """Инкрементальный пересчёт расписания, построенного этим генератором"""
+        # Отдых между этапами соблюдается только в режиме "stages"; в остальных группа идёт подряд
+        rest = self.rest_minutes if self.mode == "stages" else 0
+        return IncrementalRescheduler(schedule, self.calendar, rest)
+
+    def restore_state(self, schedule: List[ScheduleSlot], mode: str):
+        """Состояние после generate_schedule для расписания, построенного в другом процессе или взятого
+        из кэша, — для пересчёта, вывода и статистики"""
+        self.mode = mode
+        if schedule:
+            self.event_day = schedule[0].event_day
+
+    @staticmethod
+    def parse_start_time(start_time_str: str) -> int:
         hour, minute = map(int, start_time_str.split(':'))
-        start_time = datetime.now().replace(hour=hour, minute=minute, second=0, microsecond=0)
-
+        return hour * 3600 + minute * 60
+
+    def generate_schedule(self, start_time_str: str, mode: str = "greedy",
+                          time_budget: float = None, event_date: Optional[date] = None) -> List[ScheduleSlot]:
+        # Расписание считается в секундах от полуночи; дата (по умолчанию сегодня) нужна только для вывода
+        self.event_day = datetime.combine(event_date or date.today(), datetime.min.time())
+        self.mode = mode
+        return self._build_schedule(self.parse_start_time(start_time_str), mode, time_budget, self.load_all_stages)
+
+    def _build_schedule(self, start_time: int, mode: str, time_budget: Optional[float],
+                        stages_for: Callable[[bool], List[Stage]]) -> List[ScheduleSlot]:
+        """stages_for(split_heats) возвращает этапы: из данных генератора или с длительностями варианта"""
         # Загружаем все этапы
-        all_stages = self.load_all_stages()
+        all_stages = stages_for(False)
 
         if not all_stages:
             return []
 
         # Распределяем по кортам
-        schedule = self.distribute_to_courts(all_stages, start_time)
+        if mode == "optimize":
+            schedule = self.distribute_to_courts_optimized(all_stages, start_time, time_budget)
+        elif mode == "greedy":
+            schedule = self.distribute_to_courts(all_stages, start_time)
+        elif mode == "stages":
+            schedule = self.distribute_stages_across_courts(all_stages, start_time)
+
+            # Параллельные заходы оставляем, только если они сокращают время окончания
+            if self.parallel_heats:
+                backfilled_minutes = self.backfilled_minutes
+                heat_schedule = self.distribute_stages_across_courts(stages_for(True), start_time)
+                if max(s.end for s in heat_schedule) < max(s.end for s in schedule):
+                    schedule = heat_schedule
+                else:
+                    self.backfilled_minutes = backfilled_minutes
+        else:
+            raise ValueError(f"Неизвестный режим генерации: {mode}")
 
         return schedule
 
-    def format_schedule_as_text(self, schedule: List[ScheduleSlot], court_num: int) -> str:
-        court_slots = [slot for slot in schedule if slot.court == court_num]
+    def what_if(self, variants: Iterable[ScheduleVariant], start_time_str: str, mode: str = "greedy",
+                time_budget: float = None) -> List[VariantResult]:
+        """Оценивает набор вариантов времени упражнений, начала и числа кортов за один вызов.
+
+        Данные читаются один раз, длительности этапов всех вариантов считаются одной матрицей NumPy,
+        затем для каждого варианта строится расписание. Состояние генератора не меняется.
+        """
+        variants = list(variants)
+        for variant in variants:
+            if variant.courts is not None and not 1 <= variant.courts <= self.MAX_COURTS:
+                raise ValueError(f"Количество кортов должно быть от 1 до {self.MAX_COURTS}")
+            courts = variant.courts or self.courts
+            if mode == "stages" and self.final_court is not None and self.final_court > courts:
+                raise ValueError(f"Корт для финалов {self.final_court} отсутствует в варианте с {courts} кортами")
+
+        by_courts: Dict[int, List[int]] = {}
+        for i, variant in enumerate(variants):
+            by_courts.setdefault(variant.courts or self.courts, []).append(i)
+
+        splits = (False, True) if mode == "stages" and self.parallel_heats else (False,)
+        saved = self.courts, self.event_day, self.backfilled_minutes
+        results: List[Optional[VariantResult]] = [None] * len(variants)
+        try:
+            if self.event_day is None:
+                self.event_day = datetime.combine(date.today(), datetime.min.time())
+            for courts, indices in by_courts.items():
+                # Число заходов зависит от числа кортов, поэтому шаблон этапов — на каждое значение
+                self.courts = courts
+                templates = {split: self.load_all_stages(split_heats=split) for split in splits}
+                matrices = {
+                    split: self._variant_durations(templates[split], [variants[i] for i in indices])
+                    for split in splits
+                }
+
+                for row, i in enumerate(indices):
+                    variant = variants[i]
+                    start = self.parse_start_time(variant.start_time or start_time_str)
+
+                    def stages_for(split_heats: bool) -> List[Stage]:
+                        return [
+                            replace(stage, duration=duration)
+                            for stage, duration in zip(templates[split_heats], matrices[split_heats][row].tolist())
+                        ]
+
+                    schedule = self._build_schedule(start, mode, time_budget, stages_for)
+                    results[i] = self._variant_result(variant, schedule, start)
+        finally:
+            self.courts, self.event_day, self.backfilled_minutes = saved
+
+        return results
+
+    def _variant_durations(self, stages: List[Stage], variants: List[ScheduleVariant]) -> np.ndarray:
+        """Матрица длительностей (вариант × этап) в секундах по формуле calculate_stage_duration"""
+        exercises = sorted({stage.exercise for stage in stages})
+        column = {exercise: j for j, exercise in enumerate(exercises)}
+        times = np.array([
+            [variant.exercise_times.get(exercise, self.exercise_times.get(exercise, 0)) for exercise in exercises]
+            for variant in variants
+        ], dtype=float).reshape(len(variants), len(exercises))
+
+        participants = np.array([stage.participants for stage in stages], dtype=float)
+        exercise_time = times[:, np.array([column[stage.exercise] for stage in stages], dtype=int)]
 
-        if not court_slots:
-            return f"Корт {court_num}: Нет выступлений"
+        duration = participants * exercise_time
+        duration = duration + np.where(participants > 19, participants / 2, 0) * exercise_time
+        duration = duration + np.where(participants > 8, 8, 0) * exercise_time
+        duration = duration + self.BREAK_BETWEEN_GROUPS
+        return np.rint(duration * 60).astype(np.int64)
+
+    def _variant_result(self, variant: ScheduleVariant, schedule: List[ScheduleSlot], start: int) -> VariantResult:
+        end = max((slot.end for slot in schedule), default=start)
+        busy = {court: 0 for court in self.court_numbers}
+        for slot in schedule:
+            busy[slot.court] += slot.end - slot.start
+        return VariantResult(
+            variant=variant,
+            courts=self.courts,
+            start=start,
+            end=end,
+            court_load={court: seconds / 60 for court, seconds in busy.items()},
+            idle_minutes=sum(end - start - seconds for seconds in busy.values()) / 60
+        )
 
-        # Сортируем по времени
-        court_slots.sort(key=lambda x: x.start_time)
+    def schedule_statistics(self, schedule: List[ScheduleSlot]) -> ScheduleStatistics:
+        """Загрузка кортов, простой из-за перерывов, критический путь и нижняя оценка окончания.
+
+        Слоты проходятся один раз в порядке (корт, время начала).
+        """
+        rest = self._to_seconds(self.rest_minutes) if self.mode == "stages" else 0
+        slots = sorted(schedule, key=lambda x: (x.court, x.start))
+        origin = min((slot.start for slot in slots), default=0)
+        end = max((slot.end for slot in slots), default=origin)
+
+        busy = {court: 0 for court in self.court_numbers}
+        counts = {court: 0 for court in self.court_numbers}
+        break_idle = {court: 0 for court in self.court_numbers}
+        court_prev: Dict[int, ScheduleSlot] = {}  # id(слот) -> предыдущий слот корта
+        # Для каждой группы по stage_order: наибольшая длительность и последний закончившийся слот уровня
+        levels: Dict[str, Dict[int, Tuple[int, ScheduleSlot]]] = {}
+        last: Optional[ScheduleSlot] = None
+        prev: Optional[ScheduleSlot] = None
+
+        for slot in slots:
+            if prev is not None and prev.court == slot.court:
+                gap_start = prev.end
+                court_prev[id(slot)] = prev
+            else:
+                gap_start = origin
+            # Простой считается вызванным перерывом, если этап перенесён за него целиком
+            gap = slot.start - gap_start
+            if gap > 0:
+                pushed = self.calendar.next_feasible_start(gap_start, slot.stage.duration) == slot.start
+                break_idle[slot.court] += gap if pushed else self.calendar.blocked_between(gap_start, slot.start)
+
+            busy[slot.court] += slot.end - slot.start
+            counts[slot.court] += 1
+            group_levels = levels.setdefault(slot.stage.group_id, {})
+            duration, level_last = group_levels.get(slot.stage.stage_order, (0, slot))
+            group_levels[slot.stage.stage_order] = (
+                max(duration, slot.stage.duration), slot if slot.end >= level_last.end else level_last
+            )
+            if last is None or (slot.end, slot.court) > (last.end, last.court):
+                last = slot
+            prev = slot
+
+        # Критический путь: от последнего слота назад по ограничению, которое задало его начало
+        critical_path = []
+        slot = last
+        while slot is not None:
+            critical_path.append(slot)
+            candidates = []
+            if id(slot) in court_prev:
+                candidates.append((court_prev[id(slot)].end, court_prev[id(slot)]))
+            orders = sorted(levels[slot.stage.group_id])
+            level = orders.index(slot.stage.stage_order)
+            if level:
+                previous = levels[slot.stage.group_id][orders[level - 1]][1]
+                candidates.append((previous.end + rest, previous))
+            if not candidates:
+                break
+            bound, predecessor = max(candidates, key=lambda c: c[0])
+            explained = self.calendar.next_feasible_start(max(bound, origin), slot.stage.duration) == slot.start
+            slot = predecessor if explained and bound > origin else None
+        critical_path.reverse()
+
+        # Нижняя оценка: вся работа на всех кортах без простоя и самая длинная цепочка этапов группы,
+        # в обоих случаях этапы не идут во время перерывов
+        lower_bound = self.calendar.advance(origin, -(-sum(busy.values()) // self.courts))
+        for group_levels in levels.values():
+            chain = sum(duration for duration, _ in group_levels.values())
+            lower_bound = max(
+                lower_bound,
+                self.calendar.advance(origin, chain),
+                origin + chain + rest * (len(group_levels) - 1)
+            )
+
+        return ScheduleStatistics(
+            start=origin,
+            end=end,
+            lower_bound=min(lower_bound, end),
+            courts=[
+                CourtStatistics(
+                    court=court,
+                    slots=counts[court],
+                    busy_minutes=busy[court] / 60,
+                    idle_minutes=(end - origin - busy[court]) / 60,
+                    break_idle_minutes=break_idle[court] / 60,
+                    venue=self.venue
+                )
+                for court in self.court_numbers
+            ],
+            critical_path=critical_path
+        )
 
-        text = f"*КОРТ {court_num}*\n"
-        text += "━" * 50 + "\n\n"
+    @staticmethod
+    def format_variants_as_text(results: List[VariantResult]) -> str:
+        """Таблица сравнения вариантов для одного сообщения"""
+        lines = [f"{'Вариант':<12} {'Корты':>5} {'Начало':>6} {'Конец':>9} {'Простой':>8}"]
+        for i, result in enumerate(results, 1):
+            lines.append(
+                f"{(result.variant.label or f'#{i}')[:12]:<12} {result.courts:>5} "
+                f"{ScheduleCalendar.format_offset(result.start):>6} {ScheduleCalendar.format_offset(result.end):>9} "
+                f"{result.idle_minutes:>6.0f}м"
+            )
+        return "```\n" + "\n".join(lines) + "\n```"
+
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def escape_markdown(text: str) -> str:
+        """Экранирует символы разметки Telegram Markdown в пользовательских названиях"""
+        return ScheduleGenerator.MARKDOWN_SPECIAL.sub(r"\\\1", str(text))
 
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def strip_markdown(text: str) -> str:
+        """Убирает символы разметки из текста внутри *...* или _..._ — экранировать там нельзя"""
+        return ScheduleGenerator.MARKDOWN_SPECIAL.sub("", str(text))
+
+    def format_schedule_as_text(self, schedule: List[ScheduleSlot], court_num: int) -> str:
+        court_slots = sorted((slot for slot in schedule if slot.court == court_num), key=lambda x: x.start)
+
+        if not court_slots:
+            return f"{self._court_title(court_num)}: Нет выступлений"
+
+        return self._court_header(court_num) + "".join(self._court_blocks(court_slots))
+
+    def render_court_messages(self, schedule: List[ScheduleSlot],
+                              limit: int = None) -> Dict[int, List[str]]:
+        """Готовые к отправке сообщения по всем кортам за один проход по расписанию.
+
+        Каждое сообщение не длиннее limit; блок группы, перерыв или смена дня не разрываются.
+        """
+        if limit is None:
+            limit = self.TELEGRAM_MESSAGE_LIMIT
+        messages: Dict[int, List[str]] = {court: [] for court in self.court_numbers}
+
+        slots = sorted(schedule, key=lambda x: (x.court, x.start))
+        begin = 0
+        while begin < len(slots):
+            court = slots[begin].court
+            end = begin
+            while end < len(slots) and slots[end].court == court:
+                end += 1
+            messages[court] = self._chunk_blocks(court, self._court_blocks(slots[begin:end]), limit)
+            begin = end
+
+        for court, court_messages in messages.items():
+            if not court_messages:
+                court_messages.append(f"{self._court_title(court)}: Нет выступлений")
+        return messages
+
+    def _court_title(self, court_num: int) -> str:
+        return f"{self.venue}, корт {court_num}" if self.venue else f"Корт {court_num}"
+
+    def _court_header(self, court_num: int, part: int = 0) -> str:
+        title = f"*КОРТ {court_num}*"
+        if self.venue:
+            title = f"*{self.strip_markdown(self.venue.upper())} — КОРТ {court_num}*"
+        if part:
+            title += f" (часть {part})"
+        return title + "\n" + "━" * 50 + "\n\n"
+
+    @staticmethod
+    def _message_length(text: str) -> int:
+        # Telegram считает длину в UTF-16: эмодзи вроде 📍 занимают две единицы
+        return len(text.encode('utf-16-le')) // 2
+
+    def _chunk_blocks(self, court_num: int, blocks: Iterable[str], limit: int) -> List[str]:
+        # Заголовок с номером части добавляется потом, место под него резервируется сразу
+        budget = limit - self._message_length(self._court_header(court_num, 999))
+        chunks: List[List[str]] = [[]]
+        size = 0
+        for block in blocks:
+            block_size = self._message_length(block)
+            if chunks[-1] and size + block_size > budget:
+                chunks.append([])
+                size = 0
+            chunks[-1].append(block)
+            size += block_size
+
+        if len(chunks) == 1:
+            return [self._court_header(court_num) + "".join(chunks[0])]
+        return [self._court_header(court_num, part) + "".join(chunk) for part, chunk in enumerate(chunks, 1)]
+
+    def _court_blocks(self, court_slots: List[ScheduleSlot]) -> Iterator[str]:
+        """Блоки текста корта: выступления группы в одно время, перерывы календаря и смена дня"""
         # Группируем слоты по времени начала и группе
         current_time = None
         current_group = None
         stages_by_type = {"отбор": [], "полуфинал": [], "финал": []}
-        prev_hour = None
-
-        for i, slot in enumerate(court_slots):
-            time_str = slot.start_time.strftime('%H:%M')
-            current_hour = slot.start_time.hour
-
-            # Проверяем, нужно ли вставить обед (переход через 13:00)
-            if prev_hour is not None and prev_hour < 13 and current_hour >= 13:
-                # Выводим накопленное перед обедом
-                if current_time:
-                    text += self._format_group_block(current_time, current_group, stages_by_type)
-                    stages_by_type = {"отбор": [], "полуфинал": [], "финал": []}
-                text += "\n🍽 *ОБЕД (13:00 - 13:30)*\n\n"
-
-            # Если новое время или новая группа - выводим накопленное
-            if (time_str != current_time or slot.stage.group_name != current_group) and current_time is not None:
-                text += self._format_group_block(current_time, current_group, stages_by_type)
+        prev_slot = None
+
+        for slot in court_slots:
+            time_str = self._clock(slot.start)
+
+            # Перерывы календаря и смена дня между предыдущим и текущим выступлением
+            breaks = []
+            new_day = prev_slot is not None and slot.start // self.DAY_SECONDS != prev_slot.start // self.DAY_SECONDS
+            if prev_slot is not None:
+                breaks = self.calendar.intervals_between(prev_slot.start, slot.start)
+
+            # Если новое время, новая группа, перерыв или новый день - выводим накопленное
+            if current_time is not None and (breaks or new_day or time_str != current_time
+                                             or slot.stage.group_name != current_group):
+                yield self._format_group_block(current_time, current_group, stages_by_type)
                 stages_by_type = {"отбор": [], "полуфинал": [], "финал": []}
+                current_time = None
+
+            for interval in breaks:
+                icon = "🍽" if "обед" in interval.label.lower() else "⏸"
+                yield f"\n{icon} *{self.strip_markdown(interval.label)} ({interval.time_range})*\n\n"
+
+            if new_day:
+                yield f"📅 *{slot.start_time.strftime('%d.%m')}*\n\n"
 
             # Накапливаем этапы
             stages_by_type[slot.stage.stage_type].append(slot.stage)
             current_time = time_str
             current_group = slot.stage.group_name
-            prev_hour = current_hour
+            prev_slot = slot
 
         # Выводим последний блок
         if current_time:
-            text += self._format_group_block(current_time, current_group, stages_by_type)
+            yield self._format_group_block(current_time, current_group, stages_by_type)
 
-        return text
+    def _subgroup_label(self, stage: Stage) -> str:
+        subgroup = self.escape_markdown(stage.subgroup_name)
+        return f"{subgroup} (заход {stage.heat})" if stage.heat else subgroup
 
     def _format_group_block(self, time: str, group: str, stages_by_type: dict) -> str:
-        text = f"⏰ *{time}* — {group}\n"
+        lines = [f"⏰ *{time}* — {self.escape_markdown(group)}\n"]
 
         # Отбор
         if stages_by_type["отбор"]:
-            subgroups = [s.subgroup_name for s in stages_by_type["отбор"]]
-            text += f"   📍 Отбор: {', '.join(subgroups)}\n"
+            subgroups = [self._subgroup_label(s) for s in stages_by_type["отбор"]]
+            lines.append(f"   📍 Отбор: {', '.join(subgroups)}\n")
 
         # Полуфинал
         if stages_by_type["полуфинал"]:
-            subgroups = [s.subgroup_name for s in stages_by_type["полуфинал"]]
-            text += f"   🥈 Полуфинал: {', '.join(subgroups)}\n"
+            subgroups = [self._subgroup_label(s) for s in stages_by_type["полуфинал"]]
+            lines.append(f"   🥈 Полуфинал: {', '.join(subgroups)}\n")
 
         # Финал
         if stages_by_type["финал"]:
-            subgroups = [s.subgroup_name for s in stages_by_type["финал"]]
+            subgroups = [self.escape_markdown(s.subgroup_name) for s in stages_by_type["финал"]]
             # Получаем упражнения из первого этапа (они одинаковые для группы)
-            exercises = stages_by_type["финал"][0].exercises if stages_by_type["финал"] else []
-            exercises_str = ", ".join(exercises) if exercises else "—"
-            text += f"   🥇 Финал: {', '.join(subgroups)}\n"
-            text += f"      Пхумсе: _{exercises_str}_\n"
+            exercises = stages_by_type["финал"][0].exercises
+            exercises_str = ", ".join(map(self.strip_markdown, exercises)) if exercises else "—"
+            lines.append(f"   🥇 Финал: {', '.join(subgroups)}\n")
+            lines.append(f"      Пхумсе: _{exercises_str}_\n")
 
-        text += "\n"
-        return text
+        lines.append("\n")
+        return "".join(lines)
 
-    def save_schedule_to_excel(self, schedule: List[ScheduleSlot], output_file: str = None):
-        """Сохраняет расписание в Excel файл"""
+    def save_schedule_to_excel(self, schedule: List[ScheduleSlot], output_file: Union[str, BinaryIO] = None):
+        """Сохраняет расписание в Excel файл (путь или файловый объект).
+
+        Строки пишутся потоком в write-only книгу openpyxl, без DataFrame и полной модели листа.
+        """
         if output_file is None:
-            output_file = self.excel_file.replace('.xlsx', '_generated.xlsx')
+            output_file = os.path.splitext(self.processed_data_file or 'schedule.xlsx')[0] + '_generated.xlsx'
+
+        wb = Workbook(write_only=True)
+        self._write_schedule_sheets(wb, schedule)
+        wb.save(output_file)
+        return output_file
 
-        # Группируем по кортам
-        court_schedules = {1: [], 2: [], 3: []}
+    def _write_schedule_sheets(self, wb: Workbook, schedule: List[ScheduleSlot], multi_day: bool = None):
+        """Листы кортов и лист статистики; для нескольких залов вызывается генератором каждого зала"""
+        # Для многодневных соревнований добавляем столбец с датой
+        if multi_day is None:
+            multi_day = self._is_multi_day(schedule)
+        columns = (('Дата',) if multi_day else ()) + self.EXCEL_COLUMNS
+
+        for sheet, slots in self._court_sheets(schedule):
+            self._write_table(wb.create_sheet(sheet), columns, (row for _, row in self._court_rows(slots, multi_day)))
+
+        if schedule:
+            ws = wb.create_sheet(self._sheet_name(self.STATISTICS_SHEET))
+            courts_table, summary_table = self._statistics_tables(self.schedule_statistics(schedule))
+            self._write_table(ws, *courts_table)
+            ws.append([])
+            self._write_table(ws, *summary_table)
+
+    def _court_sheets(self, schedule: List[ScheduleSlot]) -> Iterator[Tuple[str, List[ScheduleSlot]]]:
+        """(название листа, слоты корта по времени) для каждого корта"""
+        court_schedules = {court: [] for court in self.court_numbers}
         for slot in schedule:
             court_schedules[slot.court].append(slot)
+        for court_num in self.court_numbers:
+            yield self._sheet_name(f'Корт {court_num}'), sorted(court_schedules[court_num], key=lambda x: x.start)
+
+    def _is_multi_day(self, schedule: List[ScheduleSlot]) -> bool:
+        return len({slot.start // self.DAY_SECONDS for slot in schedule}) > 1
+
+    def view_index(self, schedule: List[ScheduleSlot]) -> "ScheduleViewIndex":
+        """Индекс просмотра — тот же, что ScheduleViewIndex.from_workbook построит по файлу Excel"""
+        return ScheduleViewIndex(self._view_entries(schedule, self._is_multi_day(schedule)))
+
+    def _view_entries(self, schedule: List[ScheduleSlot], multi_day: bool) -> Iterator[Tuple[str, str, "StageView"]]:
+        for sheet, slots in self._court_sheets(schedule):
+            # Номера строк — как в листе: заголовок в первой строке, перерывы тоже занимают строки
+            for row_number, (slot, row) in enumerate(self._court_rows(slots, multi_day), 2):
+                if slot is not None:
+                    yield slot.stage.group_name, slot.stage.subgroup_name, StageView(
+                        sheet=sheet,
+                        row=row_number,
+                        time=self._clock(slot.start),
+                        stage=slot.stage.stage_label,
+                        participants=slot.stage.participants,
+                        poomse=slot.stage.exercise,
+                        date=row[0] if multi_day else "",
+                        duration=round(slot.stage.duration_minutes, 1)
+                    )
+
+    def _sheet_name(self, name: str) -> str:
+        # Название листа Excel — не длиннее 31 символа и без []:*?/\
+        if not self.venue:
+            return name
+        venue = self.SHEET_NAME_INVALID.sub('', self.venue)[:self.SHEET_NAME_LIMIT - len(name) - 3]
+        return f"{venue} - {name}"
+
+    def schedule_to_excel_bytes(self, schedule: List[ScheduleSlot]) -> bytes:
+        """Excel с расписанием в памяти — для отправки и кэша без временных файлов"""
+        buffer = io.BytesIO()
+        self.save_schedule_to_excel(schedule, buffer)
+        return buffer.getvalue()
+
+    @staticmethod
+    def _write_table(ws, columns: Iterable[str], rows: Iterable[list]):
+        header = []
+        for name in columns:
+            cell = WriteOnlyCell(ws, value=name)
+            # Оформление заголовка как у pandas.to_excel
+            cell.font = Font(bold=True)
+            cell.border = Border(left=Side('thin'), right=Side('thin'), top=Side('thin'), bottom=Side('thin'))
+            cell.alignment = Alignment(horizontal='center', vertical='top')
+            header.append(cell)
+        ws.append(header)
+        for row in rows:
+            ws.append(row)
+
+    @staticmethod
+    def _clock(seconds: int) -> str:
+        minutes = seconds // 60 % (24 * 60)
+        return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+    def _court_rows(self, slots: List[ScheduleSlot], multi_day: bool) -> Iterator[Tuple[Optional[ScheduleSlot], list]]:
+        """Строки листа корта: выступления и перерывы календаря внутри его рабочего времени.
+
+        Вместе со строкой возвращается её слот (None для перерыва).
+        """
+        if not slots:
+            return
+        event_day = slots[0].event_day
+
+        slot_rows = ((slot.start, slot, [
+            self._clock(slot.start),
+            slot.stage.group_name,
+            slot.stage.subgroup_name,
+            slot.stage.stage_label,
+            slot.stage.participants,
+            round(slot.stage.duration_minutes, 1),
+            self._clock(slot.end),
+            slot.stage.exercise
+        ]) for slot in slots)
+        break_rows = ((self.calendar.to_seconds(interval.start), None, [
+            interval.format_minutes(interval.start),
+            None,
+            None,
+            interval.label,
+            None,
+            round(interval.end - interval.start, 1),
+            interval.format_minutes(interval.end),
+            None
+        ]) for interval in self.calendar.intervals_between(slots[0].start, slots[-1].end))
+
+        # Оба потока уже упорядочены по времени; при равенстве выступление идёт раньше перерыва
+        dates: Dict[int, str] = {}
+        for moment, slot, row in heapq.merge(slot_rows, break_rows, key=lambda x: x[0]):
+            if multi_day:
+                day = moment // self.DAY_SECONDS
+                if day not in dates:
+                    dates[day] = self._to_datetime(moment, event_day).strftime('%d.%m.%Y')
+                row.insert(0, dates[day])
+            yield slot, row
+
+    @staticmethod
+    def _statistics_tables(statistics: ScheduleStatistics) -> Tuple[Tuple[tuple, list], Tuple[tuple, list]]:
+        """Таблица по кортам и сводка для листа статистики: (заголовок, строки)"""
+        courts_rows = [[
+            str(c.court),
+            c.slots,
+            round(c.busy_minutes, 1),
+            round(c.idle_minutes, 1),
+            round(c.break_idle_minutes, 1),
+            round(c.utilization * 100, 1),
+        ] for c in statistics.courts]
+        courts_rows.append([
+            'Все',
+            sum(c.slots for c in statistics.courts),
+            round(sum(c.busy_minutes for c in statistics.courts), 1),
+            round(sum(c.idle_minutes for c in statistics.courts), 1),
+            round(sum(c.break_idle_minutes for c in statistics.courts), 1),
+            round(statistics.utilization * 100, 1),
+        ])
+        summary_rows = [
+            ['Окончание', ScheduleCalendar.format_offset(statistics.end)],
+            ['Нижняя оценка окончания', ScheduleCalendar.format_offset(statistics.lower_bound)],
+            ['Отставание от оценки (мин)', round(statistics.gap_minutes, 1)],
+            ['Критический путь', ' → '.join(statistics.critical_groups)],
+        ]
+        return (
+            (('Корт', 'Выступлений', 'Занято (мин)', 'Простой (мин)', 'Простой из-за перерывов (мин)', 'Загрузка, %'),
+             courts_rows),
+            (('Показатель', 'Значение'), summary_rows),
+        )
 
-        # Создаем Excel writer
-        with pd.ExcelWriter(output_file, engine='openpyxl') as writer:
-            for court_num in [1, 2, 3]:
-                slots = court_schedules[court_num]
-
-                # Формируем данные для листа
-                data = []
-                for slot in slots:
-                    data.append({
-                        'Время': slot.start_time.strftime('%H:%M'),
-                        'Группа': slot.stage.group_name,
-                        'Подгруппа': slot.stage.subgroup_name,
-                        'Этап': slot.stage.stage_type,
-                        'Участников': slot.stage.participants,
-                        'Длительность (мин)': round(slot.stage.duration_minutes, 1),
-                        'Окончание': slot.end_time.strftime('%H:%M'),
-                        'Пхумсе': ', '.join(slot.stage.exercises)
-                    })
-
-                df = pd.DataFrame(data)
-                sheet_name = f'Корт {court_num}'
-                df.to_excel(writer, sheet_name=sheet_name, index=False)
 
+@dataclass
+class Venue:
+    """Зал соревнований: свои корты и свой календарь перерывов"""
+    name: str
+    courts: int = ScheduleGenerator.DEFAULT_COURTS
+    calendar: Optional[ScheduleCalendar] = None  # None — стандартный обед
+
+
+def generate_venue_schedule(generator: ScheduleGenerator, start_time_str: str, mode: str,
+                            time_budget: Optional[float], event_date: Optional[date]) -> Tuple[List[ScheduleSlot], float]:
+    # Выполняется в процессе пула, поэтому функция модульного уровня
+    schedule = generator.generate_schedule(start_time_str, mode=mode, time_budget=time_budget, event_date=event_date)
+    return schedule, generator.backfilled_minutes
+
+
+class MultiVenueScheduler:
+    """Соревнования в нескольких залах одновременно.
+
+    Группы целиком распределяются между залами так, чтобы выровнять нагрузку на корт
+    (закреплённые группы — в заданном зале), затем расписание каждого зала строится своим
+    ScheduleGenerator (независимо, в боте — параллельно в пуле процессов) и результаты
+    объединяются; зал записан в каждом слоте.
+    """
+
+    def __init__(self, processed_data: Union[str, pd.DataFrame, List[GroupRecord]], venues: List[Venue],
+                 pinned: Optional[Dict[str, str]] = None, **options):
+        # options — остальные параметры ScheduleGenerator (backfill, rest_minutes, ...), общие для всех залов
+        names = [venue.name for venue in venues]
+        if not venues or not all(names) or len(set(names)) != len(names):
+            raise ValueError("Нужен хотя бы один зал, названия залов должны быть непустыми и различными")
+        for venue in venues:
+            if not 1 <= venue.courts <= ScheduleGenerator.MAX_COURTS:
+                raise ValueError(f"{venue.name}: количество кортов должно быть от 1 до {ScheduleGenerator.MAX_COURTS}")
+        # Закреплённые группы: нормализованное название группы -> зал
+        self.pinned = {normalize_group_name(group): venue for group, venue in (pinned or {}).items()}
+        unknown = set(self.pinned.values()) - set(names)
+        if unknown:
+            raise ValueError(f"Неизвестные залы в закреплении групп: {', '.join(sorted(unknown))}")
+
+        self.venues = list(venues)
+        self.options = options
+        # Общий генератор: данные читаются один раз, по его этапам оценивается нагрузка групп
+        self.base = ScheduleGenerator(processed_data, **options)
+        self.generators: Dict[str, ScheduleGenerator] = {}
+        self.assignment: Dict[str, str] = {}  # группа -> зал последнего разбиения
+        self.mode: Optional[str] = None
+
+    def set_exercise_times(self, exercise_times: Dict[str, float]):
+        self.base.set_exercise_times(exercise_times)
+
+    @property
+    def backfilled_minutes(self) -> float:
+        return sum(generator.backfilled_minutes for generator in self.generators.values())
+
+    def partition(self) -> Dict[str, List[GroupRecord]]:
+        """Записи групп по залам: группа не делится, нагрузка — суммарная длительность её этапов.
+
+        Сначала размещаются закреплённые группы, затем остальные от самой долгой к самой короткой
+        (LPT) — в зал с наименьшей нагрузкой на корт после добавления группы.
+        """
+        records: Dict[str, List[GroupRecord]] = {}
+        for record in self.base.get_group_records():
+            records.setdefault(record.group_name, []).append(record)
+        loads = dict.fromkeys(records, 0)
+        for stage in self.base.load_all_stages():
+            loads[stage.group_name] += stage.duration
+
+        venue_load = {venue.name: 0 for venue in self.venues}
+        courts = {venue.name: venue.courts for venue in self.venues}
+        self.assignment = {}
+        pinned = [group for group in records if normalize_group_name(group) in self.pinned]
+        free = sorted((group for group in records if normalize_group_name(group) not in self.pinned),
+                      key=lambda group: -loads[group])
+        for group in pinned + free:
+            venue = self.pinned.get(normalize_group_name(group))
+            if venue is None:
+                # При равенстве — зал, указанный раньше
+                venue = min(venue_load, key=lambda name: (venue_load[name] + loads[group]) / courts[name])
+            venue_load[venue] += loads[group]
+            self.assignment[group] = venue
+
+        partition: Dict[str, List[GroupRecord]] = {venue.name: [] for venue in self.venues}
+        for group, group_records in records.items():
+            partition[self.assignment[group]].extend(group_records)
+        return partition
+
+    def fingerprint(self, start_time_str: str, mode: str = "greedy", event_date: Optional[date] = None) -> str:
+        """Отпечаток входных данных с учётом залов и закреплений — ключ кэша результатов"""
+        payload = {
+            'base': self.base.fingerprint(start_time_str, mode, event_date),
+            'venues': [
+                [venue.name, venue.courts,
+                 [[i.start, i.end, i.label] for i in venue.calendar.intervals] if venue.calendar else None]
+                for venue in self.venues
+            ],
+            'pinned': sorted(self.pinned.items()),
+        }
+        encoded = json.dumps(payload, ensure_ascii=False, sort_keys=True).encode('utf-8')
+        return hashlib.sha256(encoded).hexdigest()
+
+    def generate_schedule(self, start_time_str: str, mode: str = "greedy", time_budget: float = None,
+                          event_date: Optional[date] = None) -> List[ScheduleSlot]:
+        """Общее расписание всех залов, упорядоченное по времени, залу и корту.
+
+        Залы считаются по очереди в текущем процессе. Параллельно — отдельными задачами пула бота
+        (workers.generate_in_pool) через prepare_venues, generate_venue_schedule и merge_venue_schedules.
+        """
+        venues = self.prepare_venues(mode)
+        results = {name: generate_venue_schedule(generator, start_time_str, mode, time_budget, event_date)
+                   for name, generator in venues.items()}
+        return self.merge_venue_schedules(results, mode, event_date)
+
+    def prepare_venues(self, mode: str) -> Dict[str, ScheduleGenerator]:
+        """Разбивает группы по залам и создаёт генераторы залов.
+
+        Возвращает генераторы залов, которым достались группы: каждый считается независимо
+        через generate_venue_schedule, результаты собирает merge_venue_schedules.
+        """
+        self.mode = mode
+        partition = self.partition()
+        self._create_generators(partition)
+        return {name: generator for name, generator in self.generators.items() if partition[name]}
+
+    def merge_venue_schedules(self, results: Dict[str, Tuple[List[ScheduleSlot], float]], mode: str,
+                              event_date: Optional[date] = None) -> List[ScheduleSlot]:
+        """Общее расписание из результатов generate_venue_schedule по залам"""
+        # Состояние генераторов, посчитанное в другом процессе, нужно для вывода и статистики
+        event_day = datetime.combine(event_date or date.today(), datetime.min.time())
+        for generator in self.generators.values():
+            generator.event_day, generator.mode = event_day, mode
+        order = {venue.name: i for i, venue in enumerate(self.venues)}
+        schedule = []
+        for name, (venue_schedule, backfilled_minutes) in results.items():
+            self.generators[name].backfilled_minutes = backfilled_minutes
+            schedule.extend(venue_schedule)
+        schedule.sort(key=lambda x: (x.start, order[x.venue], x.court))
+        return schedule
+
+    def _create_generators(self, partition: Dict[str, List[GroupRecord]]):
+        self.generators = {}
+        for venue in self.venues:
+            generator = ScheduleGenerator(partition[venue.name], courts=venue.courts, calendar=venue.calendar,
+                                          venue=venue.name, **self.options)
+            generator.set_exercise_times(self.base.exercise_times)
+            self.generators[venue.name] = generator
+
+    def restore_state(self, schedule: List[ScheduleSlot], mode: str):
+        """Генераторы залов и их состояние для расписания, построенного в другом процессе или взятого из кэша"""
+        self.mode = mode
+        self._create_generators(self.partition())
+        for name, slots in self._venue_slots(schedule).items():
+            self.generators[name].restore_state(slots, mode)
+
+    def _venue_slots(self, schedule: List[ScheduleSlot]) -> Dict[str, List[ScheduleSlot]]:
+        slots: Dict[str, List[ScheduleSlot]] = {name: [] for name in self.generators}
+        for slot in schedule:
+            slots[slot.venue].append(slot)
+        return slots
+
+    def rescheduler(self, schedule: List[ScheduleSlot], venue: str) -> IncrementalRescheduler:
+        """Инкрементальный пересчёт расписания одного зала: залы друг от друга не зависят"""
+        return self.generators[venue].rescheduler(self._venue_slots(schedule)[venue])
+
+    def render_court_messages(self, schedule: List[ScheduleSlot],
+                              limit: int = None) -> Dict[Tuple[str, int], List[str]]:
+        """Сообщения по кортам всех залов, ключ — (зал, корт), залы в порядке перечисления"""
+        messages: Dict[Tuple[str, int], List[str]] = {}
+        for name, slots in self._venue_slots(schedule).items():
+            for court, court_messages in self.generators[name].render_court_messages(slots, limit).items():
+                messages[(name, court)] = court_messages
+        return messages
+
+    def schedule_statistics(self, schedule: List[ScheduleSlot]) -> ScheduleStatistics:
+        """Статистика всех залов: корты каждого зала, окончание и критический путь — по залу,
+        который заканчивает последним; нижняя оценка — наибольшая из оценок залов"""
+        venue_statistics = [
+            self.generators[name].schedule_statistics(slots)
+            for name, slots in self._venue_slots(schedule).items() if slots
+        ]
+        if not venue_statistics:
+            return self.base.schedule_statistics([])
+        last = max(venue_statistics, key=lambda statistics: statistics.end)
+        return ScheduleStatistics(
+            start=min(statistics.start for statistics in venue_statistics),
+            end=last.end,
+            lower_bound=max(statistics.lower_bound for statistics in venue_statistics),
+            courts=[court for statistics in venue_statistics for court in statistics.courts],
+            critical_path=last.critical_path
+        )
+
+    def save_schedule_to_excel(self, schedule: List[ScheduleSlot], output_file: Union[str, BinaryIO] = None):
+        """Один файл на все залы: листы кортов и статистики каждого зала подряд"""
+        if output_file is None:
+            output_file = os.path.splitext(self.base.processed_data_file or 'schedule.xlsx')[0] + '_generated.xlsx'
+
+        # Столбец с датой — во всех листах сразу, если хоть один зал работает несколько дней
+        multi_day = self.base._is_multi_day(schedule)
+        wb = Workbook(write_only=True)
+        for name, slots in self._venue_slots(schedule).items():
+            self.generators[name]._write_schedule_sheets(wb, slots, multi_day)
+        wb.save(output_file)
         return output_file
+
+    def schedule_to_excel_bytes(self, schedule: List[ScheduleSlot]) -> bytes:
+        buffer = io.BytesIO()
+        self.save_schedule_to_excel(schedule, buffer)
+        return buffer.getvalue()
+
+    def view_index(self, schedule: List[ScheduleSlot]) -> "ScheduleViewIndex":
+        multi_day = self.base._is_multi_day(schedule)
+        return ScheduleViewIndex(
+            entry
+            for name, slots in self._venue_slots(schedule).items()
+            for entry in self.generators[name]._view_entries(slots, multi_day)
+        )
@@ -1,35 +1,365 @@
+import csv
+import difflib
+import hashlib
+import io
+import json
+import os
 import pandas as pd
-from typing import Dict, List, Tuple
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from openpyxl import load_workbook
+from typing import Dict, List, Optional, Tuple
+
+try:
+    # Необязательный быстрый парсер Excel (pip install python-calamine)
+    from python_calamine import CalamineWorkbook
+except ImportError:
+    CalamineWorkbook = None
+
+
+@dataclass
+class GroupRecord:
+    group_name: str
+    subgroup: str
+    participants: int
+    otbor: str = ''
+    polufinal: str = ''
+    final: str = ''
+
+
+@dataclass
+class ValidationReport:
+    unmatched_groups: List[str] = field(default_factory=list)
+    # группа с листа 1 -> похожие названия с листа 2
+    near_misses: Dict[str, List[str]] = field(default_factory=dict)
+    # (номер строки на листе 1, значение)
+    bad_participants: List[Tuple[int, str]] = field(default_factory=list)
+    missing_finals: List[str] = field(default_factory=list)
+    errors: List[str] = field(default_factory=list)
+
+    MAX_ITEMS = 20  # строк каждого раздела в сообщении
+
+    @property
+    def is_valid(self) -> bool:
+        return not (self.unmatched_groups or self.bad_participants or self.missing_finals or self.errors)
+
+    def format_text(self) -> str:
+        """Отчёт одним сообщением (без разметки, названия групп не экранируются)"""
+        if self.is_valid:
+            return "✅ Структура файла в порядке."
+
+        lines = ["❌ Файл не прошёл проверку:"]
+        lines += [f"• {error}" for error in self.errors]
+
+        def section(title: str, items: List[str]):
+            if not items:
+                return
+            lines.append("")
+            lines.append(title)
+            lines.extend(f"• {item}" for item in items[:self.MAX_ITEMS])
+            if len(items) > self.MAX_ITEMS:
+                lines.append(f"… и ещё {len(items) - self.MAX_ITEMS}")
+
+        unmatched = []
+        for group in self.unmatched_groups:
+            hints = self.near_misses.get(group)
+            unmatched.append(f"{group} (возможно: {', '.join(hints)})" if hints else group)
+
+        section("Группы с листа 1, которых нет на листе 2:", unmatched)
+        section("Некорректное количество участников:",
+                [f"строка {row}: {value}" for row, value in self.bad_participants])
+        section("Не указано упражнение для финала:", self.missing_finals)
+
+        return "\n".join(lines)
+
+
+def normalize_group_name(name: str) -> str:
+    return ' '.join(name.casefold().replace('ё', 'е').split())
+
+
+def records_from_dataframe(df: pd.DataFrame) -> List[GroupRecord]:
+    """Преобразует промежуточную таблицу (по позициям столбцов) в список записей групп"""
+    records = []
+
+    for row in df.itertuples(index=False, name=None):
+        # Проверяем наличие данных в строке
+        if len(row) < 3 or pd.isna(row[0]) or pd.isna(row[1]):
+            continue
+
+        group_name = str(row[0]).strip()
+        subgroup = str(row[1]).strip()
+
+        # Пропускаем заголовки
+        if 'наименование группы' in group_name.lower() or 'подгруппа' in subgroup.lower():
+            continue
+
+        participants = row[2]
+        if pd.isna(participants):
+            continue
+
+        try:
+            participants = int(float(participants))
+        except (ValueError, TypeError):
+            continue
+
+        exercises = []
+        for col in (3, 4, 5):
+            val = row[col] if len(row) > col else None
+            exercises.append(str(val).strip() if pd.notna(val) else '')
+
+        records.append(GroupRecord(group_name, subgroup, participants, *exercises))
+
+    return records
+
+
+@dataclass
+class ParsedUpload:
+    group_records: List[GroupRecord]
+    exercises: List[str]
+    # Последние введённые для этого файла времена упражнений
+    exercise_times: Dict[str, float] = field(default_factory=dict)
+
+
+class ParsedUploadCache:
+    """LRU-кэш результатов разбора загруженных файлов по хешу содержимого"""
+
+    def __init__(self, max_entries: int = 32):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, ParsedUpload]" = OrderedDict()
+
+    @staticmethod
+    def content_hash(content: bytes) -> str:
+        return hashlib.sha256(content).hexdigest()
+
+    def get(self, key: str) -> Optional[ParsedUpload]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: str, entry: ParsedUpload):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def remember_exercise_times(self, key: Optional[str], exercise_times: Dict[str, float]):
+        entry = self._entries.get(key) if key else None
+        if entry is not None:
+            entry.exercise_times = dict(exercise_times)
+
+    def __len__(self) -> int:
+        return len(self._entries)
 
 
 class DataProcessor:
-    def __init__(self, input_file: str):
+    # Количество столбцов, читаемых с листа 1 и листа 2
+    SHEET_COLUMNS = (3, 4)
+    MAX_ROWS = 50000  # строк данных на лист
+    MAX_COLUMNS = 1000  # заявленная ширина листа
+
+    FORMATS_BY_EXTENSION = {
+        '.xlsx': 'xlsx',
+        '.xlsm': 'xlsx',
+        '.xls': 'xls',
+        '.csv': 'csv',
+        '.json': 'json',
+    }
+    # Поля объектов в JSON, в порядке столбцов листов Excel
+    JSON_FIELDS = {
+        'groups': ['group', 'subgroup', 'participants'],
+        'exercises': ['group', 'otbor', 'semifinal', 'final'],
+    }
+
+    def __init__(self, input_file: str, max_rows: int = MAX_ROWS, max_columns: int = MAX_COLUMNS):
         self.input_file = input_file
+        self.max_rows = max_rows
+        self.max_columns = max_columns
         self.groups_df = None
         self.exercises_df = None
         self.intermediate_df = None
+        self._exercise_index: Optional[Dict[str, Tuple[str, str, str]]] = None
+        # Причина неудачной загрузки — попадает в отчёт validate()
+        self.load_error: Optional[str] = None
 
     def load_data(self) -> bool:
         try:
-            #Загружает лист 1 -  Группы и участники
-            self.groups_df = pd.read_excel(
-                self.input_file,
-                sheet_name=0,  #Первый лист
-                header=None
-            )
-
-            #Загружает лист 2 - Упражнения
-            self.exercises_df = pd.read_excel(
-                self.input_file,
-                sheet_name=1,  #Второй лист
-                header=None
-            )
+            # Файл открывается один раз, оба листа читаются потоково
+            input_format = self.detect_format()
+            if input_format == 'csv':
+                self.groups_df, self.exercises_df = self._read_csv()
+            elif input_format == 'json':
+                self.groups_df, self.exercises_df = self._read_json()
+            else:
+                self.groups_df, self.exercises_df = self._read_workbook(input_format)
+            self._exercise_index = None
 
             return True
         except Exception as e:
             print(f"Ошибка при загрузке файла: {e}")
+            self.load_error = str(e)
             return False
 
+    def detect_format(self) -> str:
+        """Определяет формат по расширению, а если оно неизвестно — по содержимому"""
+        ext = os.path.splitext(self.input_file)[1].lower()
+        if ext in self.FORMATS_BY_EXTENSION:
+            return self.FORMATS_BY_EXTENSION[ext]
+
+        with open(self.input_file, 'rb') as f:
+            head = f.read(64)
+
+        if head.startswith(b'PK'):
+            return 'xlsx'
+        if head.startswith(b'\xd0\xcf\x11\xe0'):
+            return 'xls'
+        if head.lstrip(b'\xef\xbb\xbf \t\r\n')[:1] in (b'{', b'['):
+            return 'json'
+        return 'csv'
+
+    def _read_text(self) -> str:
+        with open(self.input_file, 'rb') as f:
+            raw = f.read()
+        try:
+            return raw.decode('utf-8-sig')
+        except UnicodeDecodeError:
+            # Выгрузки из русского Excel часто в cp1251
+            return raw.decode('cp1251')
+
+    def _read_csv(self) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """CSV: таблица групп, пустая строка, таблица упражнений (обе с заголовком)"""
+        text = self._read_text()
+        delimiter = self._csv_delimiter(text)
+
+        sections: List[List[list]] = [[]]
+        for row in csv.reader(io.StringIO(text), delimiter=delimiter):
+            if not any(cell.strip() for cell in row):
+                if sections[-1]:
+                    sections.append([])
+                continue
+            sections[-1].append(row)
+
+        sections = [section for section in sections if section]
+        if len(sections) < 2:
+            raise ValueError("В CSV должны быть две таблицы, разделённые пустой строкой")
+
+        return tuple(
+            self._collect_rows(rows, n_cols)
+            for rows, n_cols in zip(sections, self.SHEET_COLUMNS)
+        )
+
+    @staticmethod
+    def _csv_delimiter(text: str) -> str:
+        # Разделитель определяется по заголовку первой таблицы: таблицы разной ширины сбивают csv.Sniffer
+        header = next((line for line in text.splitlines() if line.strip()), '')
+        counts = {delimiter: header.count(delimiter) for delimiter in ',;\t'}
+        delimiter = max(counts, key=counts.get)
+        if not counts[delimiter]:
+            raise ValueError("Не удалось определить разделитель CSV: в заголовке нет запятых, точек с запятой "
+                             "или табуляций")
+        return delimiter
+
+    def _read_json(self) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """JSON: {"groups": [...], "exercises": [...]}; строки — списки (с заголовком) или объекты"""
+        payload = json.loads(self._read_text())
+        if not isinstance(payload, dict) or 'groups' not in payload or 'exercises' not in payload:
+            raise ValueError("В JSON должны быть ключи 'groups' и 'exercises'")
+
+        frames = []
+        for key, n_cols in zip(('groups', 'exercises'), self.SHEET_COLUMNS):
+            rows = payload[key]
+            if rows and isinstance(rows[0], dict):
+                fields = self.JSON_FIELDS[key]
+                # Заголовок добавляется, чтобы позиции строк совпадали с листами Excel
+                rows = [fields] + [[row.get(field) for field in fields] for row in rows]
+            frames.append(self._collect_rows(rows, n_cols))
+
+        return tuple(frames)
+
+    def _read_workbook(self, input_format: str = 'xlsx') -> Tuple[pd.DataFrame, pd.DataFrame]:
+        #Лист 1 - Группы и участники, лист 2 - Упражнения
+        if input_format == 'xlsx':
+            workbook = load_workbook(self.input_file, read_only=True, data_only=True)
+            try:
+                worksheets = workbook.worksheets[:2]
+                if len(worksheets) < 2:
+                    raise ValueError("В файле должно быть два листа")
+                for worksheet in worksheets:
+                    self._check_width(worksheet.max_column)
+
+                # calamine быстрее, но сразу читает лист целиком в плотный массив — только если
+                # заявленный размер листа известен и в пределах лимитов, иначе читаем потоково
+                if CalamineWorkbook is not None and all(
+                    worksheet.max_row is not None and worksheet.max_column is not None
+                    and worksheet.max_row <= self.max_rows + 1
+                    for worksheet in worksheets
+                ):
+                    calamine = CalamineWorkbook.from_path(self.input_file)
+                    return tuple(
+                        self._calamine_sheet(calamine.get_sheet_by_index(sheet_idx), n_cols)
+                        for sheet_idx, n_cols in enumerate(self.SHEET_COLUMNS)
+                    )
+
+                return tuple(
+                    self._collect_rows(worksheet.iter_rows(max_col=n_cols, values_only=True), n_cols)
+                    for worksheet, n_cols in zip(worksheets, self.SHEET_COLUMNS)
+                )
+            finally:
+                workbook.close()
+
+        # Старые форматы (.xls) — через pandas, но тоже за одно открытие файла
+        with pd.ExcelFile(self.input_file) as excel_file:
+            frames = []
+            for sheet_idx, n_cols in enumerate(self.SHEET_COLUMNS):
+                df = excel_file.parse(sheet_idx, header=None, nrows=self.max_rows + 2)
+                self._check_width(df.shape[1])
+                frames.append(self._collect_rows(
+                    df.iloc[:, :n_cols].itertuples(index=False, name=None), n_cols
+                ))
+            return tuple(frames)
+
+    def _calamine_sheet(self, sheet, n_cols: int) -> pd.DataFrame:
+        # calamine отдаёт строки с первой, но столбцы — только с первого непустого: восстанавливаем позиции
+        start_col = (sheet.start or (0, 0))[1]
+        self._check_width(start_col + sheet.width)
+        rows = (([None] * start_col + row)[:n_cols] for row in sheet.iter_rows())
+        return self._collect_rows(rows, n_cols)
+
+    def _check_width(self, width: Optional[int]):
+        if width is not None and width > self.max_columns:
+            raise ValueError(f"Слишком много столбцов на листе: {width} (максимум {self.max_columns})")
+
+    def _collect_rows(self, rows, n_cols: int) -> pd.DataFrame:
+        """Собирает только нужные столбцы; пустые строки в конце листа не попадают в таблицу,
+        но учитываются в лимите строк"""
+        data = []
+        pending_empty = 0
+
+        for row in rows:
+            self._check_width(len(row))
+            values = []
+            for val in row[:n_cols]:
+                if isinstance(val, str) and val == '':
+                    val = None
+                elif isinstance(val, float) and val.is_integer():
+                    val = int(val)
+                values.append(val)
+            values += [None] * (n_cols - len(values))
+
+            if all(val is None for val in values):
+                pending_empty += 1
+            else:
+                data.extend([[None] * n_cols] * pending_empty)
+                pending_empty = 0
+                data.append(values)
+
+            # Заголовок + не более max_rows строк данных; пустые строки считаются сразу,
+            # чтобы большой пропуск не выделялся в памяти целиком перед отказом
+            if len(data) + pending_empty > self.max_rows + 1:
+                raise ValueError(f"Слишком много строк на листе (максимум {self.max_rows})")
+
+        return pd.DataFrame(data, columns=range(n_cols), dtype=object)
+
     def get_unique_exercises(self) -> List[str]:
         if self.exercises_df is None:
             return []
@@ -46,66 +376,116 @@ class DataProcessor:
 
         return sorted(list(exercises))
 
+    @staticmethod
+    def _clean_column(df: pd.DataFrame, col_idx: int) -> pd.Series:
+        """Столбец как строки без пробелов по краям; пустые ячейки и отсутствующий столбец — ''"""
+        if df.shape[1] <= col_idx:
+            return pd.Series('', index=df.index, dtype=object)
+        column = df.iloc[:, col_idx]
+        return column.astype(str).str.strip().where(column.notna(), '').astype(object)
+
+    def _exercises_table(self) -> pd.DataFrame:
+        """Лист 2 в виде таблицы группа -> (отбор, полуф, финал), по одной строке на группу"""
+        body = self.exercises_df.iloc[1:]  # Пропускаем заголовок
+        body = body[body.iloc[:, 0].notna()]
+
+        table = pd.DataFrame({
+            'group_key': self._clean_column(body, 0),
+            'отбор': self._clean_column(body, 1),
+            'полуф': self._clean_column(body, 2),
+            'финал': self._clean_column(body, 3),
+        })
+        # При повторах используется первая строка группы
+        return table.drop_duplicates('group_key', keep='first')
+
     def find_group_exercises(self, group_name: str) -> Tuple[str, str, str]:
         if self.exercises_df is None:
             return ('', '', '')
 
-        for idx in range(1, len(self.exercises_df)):  # Пропускаем заголовок
-            if pd.notna(self.exercises_df.iloc[idx, 0]):
-                group_in_exercises = str(self.exercises_df.iloc[idx, 0]).strip()
-
-                if group_name.strip() == group_in_exercises:
-                    otbor = ''
-                    polufinal = ''
-                    final = ''
-
-                    if self.exercises_df.shape[1] > 1 and pd.notna(self.exercises_df.iloc[idx, 1]):
-                        otbor = str(self.exercises_df.iloc[idx, 1]).strip()
-
-                    if self.exercises_df.shape[1] > 2 and pd.notna(self.exercises_df.iloc[idx, 2]):
-                        polufinal = str(self.exercises_df.iloc[idx, 2]).strip()
+        if self._exercise_index is None:
+            table = self._exercises_table()
+            self._exercise_index = dict(zip(
+                table['group_key'], zip(table['отбор'], table['полуф'], table['финал'])
+            ))
 
-                    if self.exercises_df.shape[1] > 3 and pd.notna(self.exercises_df.iloc[idx, 3]):
-                        final = str(self.exercises_df.iloc[idx, 3]).strip()
+        return self._exercise_index.get(group_name.strip(), ('', '', ''))
 
-                    return (otbor, polufinal, final)
-
-        return ('', '', '')
+    def validate(self) -> ValidationReport:
+        """Быстрая проверка ключевых столбцов до построения промежуточных данных"""
+        report = ValidationReport()
+        if self.groups_df is None or self.exercises_df is None:
+            report.errors.append(self.load_error or "Данные не загружены")
+            return report
+
+        body = self.groups_df.iloc[1:]  # Пропускаем заголовок
+        body = body[body.iloc[:, 0].notna()]
+        if body.empty:
+            report.errors.append("На листе 1 нет ни одной группы")
+            return report
+
+        group_names = self._clean_column(body, 0)
+
+        if body.shape[1] > 2:
+            raw = body.iloc[:, 2]
+            numeric = pd.to_numeric(raw.astype(object), errors='coerce')
+            bad = raw.notna() & numeric.isna()
+            # Номер строки как в Excel: заголовок — строка 1
+            report.bad_participants = [(idx + 1, str(value)) for idx, value in raw[bad].items()]
+
+        table = self._exercises_table()
+        known = set(table['group_key'])
+        used = set(group_names)
+
+        report.unmatched_groups = sorted(used - known)
+
+        by_normalized: Dict[str, List[str]] = {}
+        for name in known:
+            by_normalized.setdefault(normalize_group_name(name), []).append(name)
+        candidates = sorted(known)
+        for group in report.unmatched_groups:
+            hints = by_normalized.get(normalize_group_name(group))
+            if not hints:
+                hints = difflib.get_close_matches(group, candidates, n=3, cutoff=0.7)
+            if hints:
+                report.near_misses[group] = sorted(hints)
+
+        used_table = table[table['group_key'].isin(used)]
+        report.missing_finals = sorted(used_table.loc[used_table['финал'] == '', 'group_key'])
+
+        return report
 
     def create_intermediate_data(self) -> bool:
         if self.groups_df is None or self.exercises_df is None:
             return False
 
-        intermediate_data = []
+        body = self.groups_df.iloc[1:]  # Пропускаем заголовок
+        body = body[body.iloc[:, 0].notna()]
 
-        for idx in range(1, len(self.groups_df)):
-            if pd.notna(self.groups_df.iloc[idx, 0]):
-                group_name = str(self.groups_df.iloc[idx, 0]).strip()
+        participants = pd.Series(0, index=body.index)
+        if body.shape[1] > 2:
+            numeric = pd.to_numeric(body.iloc[:, 2].astype(object), errors='coerce')
+            numeric = numeric.where(numeric.abs() != float('inf'))
+            participants = numeric.fillna(0).astype('int64')  # отбрасывает дробную часть, как int()
 
-                subgroup = ''
-                if self.groups_df.shape[1] > 1 and pd.notna(self.groups_df.iloc[idx, 1]):
-                    subgroup = str(self.groups_df.iloc[idx, 1]).strip()
+        groups = pd.DataFrame({
+            'Наименование группы': self._clean_column(body, 0),
+            'подгруппа': self._clean_column(body, 1),
+            'Количество участников': participants,
+        })
 
-                participants = 0
-                if self.groups_df.shape[1] > 2 and pd.notna(self.groups_df.iloc[idx, 2]):
-                    try:
-                        participants = int(float(self.groups_df.iloc[idx, 2]))
-                    except (ValueError, TypeError):
-                        participants = 0
+        # Один hash join листа 1 с листом 2 по наименованию группы
+        merged = groups.merge(
+            self._exercises_table(),
+            how='left',
+            left_on='Наименование группы',
+            right_on='group_key',
+        ).drop(columns='group_key')
 
-                otbor, polufinal, final = self.find_group_exercises(group_name)
+        for column in ('отбор', 'полуф', 'финал'):
+            values = merged[column].astype(object)
+            merged[column] = values.where(values.notna() & (values != ''), None)
 
-                # Добавляем в промежуточные данные
-                intermediate_data.append({
-                    'Наименование группы': group_name,
-                    'подгруппа': subgroup,
-                    'Количество участников': participants,
-                    'отбор': otbor if otbor else None,
-                    'полуф': polufinal if polufinal else None,
-                    'финал': final if final else None
-                })
-
-        self.intermediate_df = pd.DataFrame(intermediate_data)
+        self.intermediate_df = merged.reset_index(drop=True)
 
         return True
 
@@ -121,9 +501,15 @@ class DataProcessor:
     def get_intermediate_dataframe(self) -> pd.DataFrame:
         return self.intermediate_df
 
-    def process(self, output_file: str = 'processed_data.xlsx') -> Tuple[bool, str, List[str]]:
-        #Загрузка данных
-        if not self.load_data():
+    def get_group_records(self) -> List[GroupRecord]:
+        if self.intermediate_df is None:
+            return []
+        return records_from_dataframe(self.intermediate_df)
+
+    def process(self, output_file: Optional[str] = None) -> Tuple[bool, str, List[str]]:
+        """Обрабатывает файл. Промежуточный Excel пишется только если передан output_file"""
+        #Загрузка данных (если ещё не загружены, например при проверке)
+        if (self.groups_df is None or self.exercises_df is None) and not self.load_data():
             return (False, '', [])
 
         exercises = self.get_unique_exercises()
@@ -131,6 +517,9 @@ class DataProcessor:
         if not self.create_intermediate_data():
             return (False, '', exercises)
 
+        if output_file is None:
+            return (True, '', exercises)
+
         try:
             saved_file = self.save_intermediate_data(output_file)
             return (True, saved_file, exercises)
@@ -141,7 +530,7 @@ class DataProcessor:
 
 if __name__ == "__main__":
     processor = DataProcessor("user_input.xlsx")
-    success, output_file, exercises = processor.process()
+    success, output_file, exercises = processor.process('processed_data.xlsx')
 
     if success:
         print(f"Обработка завершена успешно!")
@@ -0,0 +1,238 @@
+import asyncio
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Set
+
+from aiogram.exceptions import TelegramRetryAfter
+
+
+class TokenBucket:
+    """Ограничение частоты: rate отправок в секунду, до capacity подряд после простоя"""
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        # До этого момента отправка запрещена — после ответа 429 с retry_after
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        # updated может быть в будущем — до конца паузы после 429 токены не копятся
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Сколько секунд ждать до следующей отправки; 0 — можно сейчас"""
+        self._refill(now)
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def consume(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, until: float):
+        # После паузы отправка продолжается в обычном темпе, а не пачкой из накопленных токенов
+        self.blocked_until = max(self.blocked_until, until)
+        self.tokens = 0.0
+        self.updated = self.blocked_until
+
+    def idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity and self.blocked_until <= now
+
+
+@dataclass
+class OutboundMessage:
+    send: Callable[[], Awaitable]
+    future: asyncio.Future
+    queued_at: float
+    attempts: int = 0
+
+
+@dataclass
+class QueueStats:
+    depth: int = 0  # сообщений ждут отправки, включая отправляемые сейчас
+    chats: int = 0
+    sent: int = 0
+    retries: int = 0  # повторов после ответа 429
+    average_wait: float = 0.0  # секунд от постановки в очередь до отправки, скользящее среднее
+    max_wait: float = 0.0
+
+    def format_text(self) -> str:
+        return (f"в очереди {self.depth} сообщ. для {self.chats} чатов, отправлено {self.sent}, "
+                f"повторов {self.retries}, ожидание в среднем {self.average_wait:.1f} с, "
+                f"максимум {self.max_wait:.1f} с")
+
+
+@dataclass
+class _ChatQueue:
+    bucket: TokenBucket
+    messages: Deque[OutboundMessage] = field(default_factory=deque)
+    sending: bool = False
+
+
+class OutboundQueue:
+    """Общая очередь исходящих сообщений бота с учётом лимитов Telegram.
+
+    Глобальный лимит и лимит на чат — корзины токенов; у групп (chat_id < 0) свой, более строгий.
+    Чаты обслуживаются по кругу, поэтому большое расписание одного пользователя не задерживает
+    остальных. В каждом чате одновременно отправляется одно сообщение — порядок сохраняется,
+    а разные чаты отправляются параллельно. На ответ 429 чат ставится на паузу retry_after
+    секунд, сообщение возвращается в начало его очереди.
+    """
+
+    WAIT_SMOOTHING = 0.2
+
+    def __init__(self, rate: float = 25, chat_rate: float = 1, chat_burst: int = 3,
+                 group_rate: float = 20 / 60, max_attempts: int = 5, report_interval: float = 30):
+        self.global_bucket = TokenBucket(rate, rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_attempts = max_attempts
+        self.report_interval = report_interval
+        self._chats: Dict[int, _ChatQueue] = {}
+        self._order: Deque[int] = deque()  # чаты с ожидающими сообщениями, по кругу
+        self._stats = QueueStats()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._sending: Set[asyncio.Task] = set()
+        self._reported = 0.0
+
+    def submit(self, chat_id: int, send: Callable[[], Awaitable]) -> asyncio.Future:
+        """Ставит отправку в очередь чата; send вызывается, когда позволяют лимиты.
+
+        Возвращает future с результатом send — ждать его нужно, только если важен момент доставки.
+        """
+        loop = asyncio.get_running_loop()
+        if self._worker is None or self._worker.done():
+            self._wakeup = asyncio.Event()
+            self._worker = loop.create_task(self._run())
+
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            rate = self.group_rate if chat_id < 0 else self.chat_rate
+            chat = self._chats[chat_id] = _ChatQueue(TokenBucket(rate, 1 if chat_id < 0 else self.chat_burst))
+        if not chat.messages and not chat.sending:
+            self._order.append(chat_id)
+        message = OutboundMessage(send, loop.create_future(), time.monotonic())
+        chat.messages.append(message)
+        self._stats.depth += 1
+        self._wakeup.set()
+        return message.future
+
+    async def send(self, chat_id: int, send: Callable[[], Awaitable]) -> Any:
+        return await self.submit(chat_id, send)
+
+    def stats(self) -> QueueStats:
+        self._stats.chats = sum(1 for chat in self._chats.values() if chat.messages or chat.sending)
+        return QueueStats(**vars(self._stats))
+
+    def estimated_wait(self, chat_id: int) -> float:
+        """Примерное время в секундах, через которое будет отправлено новое сообщение в этот чат"""
+        chat = self._chats.get(chat_id)
+        pending = len(chat.messages) if chat else 0
+        rate = self.group_rate if chat_id < 0 else self.chat_rate
+        return max(pending / rate, self._stats.depth / self.global_bucket.rate)
+
+    def close(self):
+        if self._worker is not None:
+            self._worker.cancel()
+        for task in list(self._sending):
+            task.cancel()
+        for chat in self._chats.values():
+            for message in chat.messages:
+                message.future.cancel()
+        self._chats.clear()
+        self._order.clear()
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            self._report(now)
+
+            # Первый по кругу чат, которому уже можно отправлять; он уходит в конец круга
+            chat_id, soonest = None, None
+            for _ in range(len(self._order)):
+                candidate = self._order.popleft()
+                wait = self._chats[candidate].bucket.delay(now)
+                if wait <= 0:
+                    chat_id = candidate
+                    break
+                self._order.append(candidate)
+                soonest = wait if soonest is None else min(soonest, wait)
+
+            if chat_id is None:
+                self._forget_idle(now)
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), soonest)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            global_wait = self.global_bucket.delay(now)
+            if global_wait > 0:
+                self._order.appendleft(chat_id)
+                await asyncio.sleep(global_wait)
+                continue
+
+            chat = self._chats[chat_id]
+            message = chat.messages.popleft()
+            chat.bucket.consume(now)
+            self.global_bucket.consume(now)
+            chat.sending = True
+            task = asyncio.create_task(self._deliver(chat_id, chat, message))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _deliver(self, chat_id: int, chat: _ChatQueue, message: OutboundMessage):
+        message.attempts += 1
+        try:
+            result = await message.send()
+        except TelegramRetryAfter as e:
+            if message.attempts < self.max_attempts and not message.future.done():
+                print(f"Лимит Telegram для чата {chat_id}: повтор через {e.retry_after} с")
+                chat.bucket.block(time.monotonic() + e.retry_after)
+                chat.messages.appendleft(message)
+                self._stats.retries += 1
+            else:
+                self._finish(message)
+                if not message.future.done():
+                    message.future.set_exception(e)
+        except Exception as e:
+            self._finish(message)
+            if not message.future.done():
+                message.future.set_exception(e)
+        else:
+            self._finish(message)
+            if not message.future.done():
+                message.future.set_result(result)
+        finally:
+            chat.sending = False
+            if chat.messages:
+                self._order.append(chat_id)
+            self._wakeup.set()
+
+    def _finish(self, message: OutboundMessage):
+        wait = time.monotonic() - message.queued_at
+        stats = self._stats
+        stats.depth -= 1
+        stats.sent += 1
+        stats.average_wait += (wait - stats.average_wait) * (self.WAIT_SMOOTHING if stats.sent > 1 else 1)
+        stats.max_wait = max(stats.max_wait, wait)
+
+    def _forget_idle(self, now: float):
+        # Корзины чатов без сообщений и с полным запасом токенов не нужны — новые будут такими же
+        for chat_id in [chat_id for chat_id, chat in self._chats.items()
+                        if not chat.messages and not chat.sending and chat.bucket.idle(now)]:
+            del self._chats[chat_id]
+
+    def _report(self, now: float):
+        if self._stats.depth and now - self._reported >= self.report_interval:
+            self._reported = now
+            print(f"Очередь отправки: {self.stats().format_text()}")
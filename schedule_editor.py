@@ -0,0 +1,186 @@
+import asyncio
+import os
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from openpyxl import load_workbook
+
+
+@dataclass(frozen=True)
+class CellEdit:
+    """Новое значение ячейки; столбец задаётся названием из строки заголовка"""
+    sheet: str
+    row: int  # номер строки листа, заголовок — строка 1
+    column: str
+    value: Any
+
+
+@dataclass(frozen=True)
+class RowMove:
+    """Перенос строки на другой лист — на место по дате и времени начала"""
+    sheet: str
+    row: int
+    target: str
+
+
+Edit = Union[CellEdit, RowMove]
+
+
+def _header(ws) -> Dict[str, int]:
+    return {cell.value: cell.column for cell in ws[1] if cell.value is not None}
+
+
+def _row_order(values: List[Any], header: Dict[str, int]) -> Tuple[str, str]:
+    # Порядок строк в листе: дата (ДД.ММ.ГГГГ, только в многодневном расписании), затем ЧЧ:ММ
+    def value(name: str) -> str:
+        column = header.get(name)
+        return str(values[column - 1] or '') if column and column <= len(values) else ''
+
+    date = value('Дата')
+    return date[6:] + date[3:5] + date[:2], value('Время')
+
+
+def apply_workbook_edits(path: str, edits: Iterable[Edit]) -> bool:
+    """Применяет правки за одно чтение и одну запись файла.
+
+    Правки проверяются до изменений: при ошибке в любой из них файл не меняется и возвращается False.
+    Сначала меняются ячейки (номера строк — как до правок), затем переносятся строки.
+    Файл записывается во временный рядом и подменяется через os.replace.
+    """
+    edits = list(edits)
+    wb = load_workbook(path)
+    try:
+        headers = {name: _header(wb[name]) for name in wb.sheetnames}
+        for edit in edits:
+            if edit.sheet not in headers or not 2 <= edit.row <= wb[edit.sheet].max_row:
+                return False
+            if isinstance(edit, CellEdit) and edit.column not in headers[edit.sheet]:
+                return False
+            if isinstance(edit, RowMove) and edit.target not in headers:
+                return False
+
+        for edit in edits:
+            if isinstance(edit, CellEdit):
+                wb[edit.sheet].cell(row=edit.row, column=headers[edit.sheet][edit.column], value=edit.value)
+
+        # Строки вынимаются с конца листа, чтобы номера оставшихся не сдвигались, затем вставляются
+        moves = sorted({(e.sheet, e.row): e for e in edits if isinstance(e, RowMove)}.values(),
+                       key=lambda move: (move.sheet, move.row), reverse=True)
+        moved = []
+        for move in moves:
+            ws = wb[move.sheet]
+            moved.append((move.target, [cell.value for cell in ws[move.row]]))
+            ws.delete_rows(move.row)
+        for target, values in reversed(moved):
+            ws = wb[target]
+            order = _row_order(values, headers[target])
+            position = ws.max_row + 1
+            for row in range(2, ws.max_row + 1):
+                if _row_order([cell.value for cell in ws[row]], headers[target]) > order:
+                    position = row
+                    break
+            ws.insert_rows(position)
+            for column, value in enumerate(values, 1):
+                ws.cell(row=position, column=column, value=value)
+
+        _save_atomically(path, wb.save)
+        return True
+    finally:
+        wb.close()
+
+
+def replace_workbook(path: str, content: bytes):
+    """Заменяет файл целиком — например, расписанием, пересчитанным после правки"""
+    def write(tmp_path: str):
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+
+    _save_atomically(path, write)
+
+
+def _save_atomically(path: str, save: Callable[[str], Any]):
+    # Запись во временный файл рядом и подмена через os.replace: читатели не видят недописанный файл
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        save(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class WorkbookEditor:
+    """Правки файлов Excel из обработчиков бота.
+
+    Запись в каждый файл идёт под своей asyncio-блокировкой. Правки, пришедшие, пока файл
+    занят или в течение write_behind секунд, объединяются и применяются одной записью.
+    Сама запись выполняется через run_io (пул потоков), чтобы не блокировать цикл событий.
+    """
+
+    def __init__(self, run_io: Callable[..., Awaitable], write_behind: float = 0.0):
+        self.run_io = run_io
+        self.write_behind = write_behind
+        self._locks: Dict[str, asyncio.Lock] = {}
+        # Файл -> ещё не записанные правки и общий для их авторов результат записи
+        self._pending: Dict[str, Tuple[List[Edit], asyncio.Future]] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+    def session(self, path: str) -> "EditSession":
+        return EditSession(self, path)
+
+    def lock(self, path: str) -> asyncio.Lock:
+        """Блокировка записи файла: под ней файл можно прочитать, пересчитать и заменить целиком,
+        не смешиваясь с пакетами правок"""
+        # Блокировки не удаляются: их по одной на файл пользователя, а удалённую мог бы ещё ждать кто-то другой
+        return self._locks.setdefault(os.path.abspath(path), asyncio.Lock())
+
+    async def apply(self, path: str, edits: Iterable[Edit]) -> bool:
+        edits = list(edits)
+        if not edits:
+            return True
+        path = os.path.abspath(path)
+
+        batch = self._pending.get(path)
+        if batch is None:
+            batch = self._pending[path] = ([], asyncio.get_running_loop().create_future())
+            task = asyncio.create_task(self._flush(path))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        batch[0].extend(edits)
+        return await asyncio.shield(batch[1])
+
+    async def _flush(self, path: str):
+        if self.write_behind:
+            await asyncio.sleep(self.write_behind)
+        async with self.lock(path):
+            # Пакет забирается только под блокировкой: всё, что пришло за время предыдущей записи, попадёт в него
+            edits, future = self._pending.pop(path)
+            try:
+                future.set_result(await self.run_io(apply_workbook_edits, path, edits))
+            except Exception as e:
+                print(f"Ошибка при сохранении правок {path}: {e}")
+                future.set_exception(e)
+
+
+class EditSession:
+    """Набор правок одного файла, применяемый при выходе из async with одной записью"""
+
+    def __init__(self, editor: WorkbookEditor, path: str):
+        self.editor = editor
+        self.path = path
+        self.edits: List[Edit] = []
+        self.result: Optional[bool] = None
+
+    def set(self, sheet: str, row: int, column: str, value: Any):
+        self.edits.append(CellEdit(sheet, row, column, value))
+
+    def move(self, sheet: str, row: int, target: str):
+        self.edits.append(RowMove(sheet, row, target))
+
+    async def __aenter__(self) -> "EditSession":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        # При исключении внутри блока правки отбрасываются
+        if exc_type is None:
+            self.result = await self.editor.apply(self.path, self.edits)
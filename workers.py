@@ -0,0 +1,218 @@
+import asyncio
+import functools
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import replace
+from typing import Callable, List, Optional, Tuple, Union
+
+from Generator import (MultiVenueScheduler, ScheduleGenerator, ScheduleResult, ScheduleSlot, ScheduleViewIndex,
+                       generate_venue_schedule)
+from data_processor import DataProcessor, ParsedUpload
+
+
+def _warm_up():
+    # Выполняется при запуске процесса пула: тяжёлые импорты и движки чтения Excel
+    # загружаются заранее, а не при первой задаче пользователя
+    import numpy  # noqa: F401
+    import openpyxl  # noqa: F401
+    import pandas  # noqa: F401
+
+
+def _ping() -> int:
+    return os.getpid()
+
+
+class WorkerPool:
+    """Пул для блокирующей работы бота, чтобы цикл событий оставался свободным.
+
+    Разбор файлов и генерация расписаний идут в пуле процессов (run), чтение и запись
+    файлов — в пуле потоков (run_io). Одновременно в процессах выполняется не больше
+    max_concurrent задач; у каждой задачи есть таймаут. По таймауту вызывающий получает
+    TimeoutError сразу, а место в пуле освобождается, когда задача действительно закончится.
+    """
+
+    def __init__(self, processes: int = None, threads: int = 8, max_concurrent: int = None,
+                 timeout: float = 120, io_timeout: float = 30):
+        self.processes = processes or min(4, os.cpu_count() or 1)
+        self.threads = threads
+        self.max_concurrent = max_concurrent or self.processes
+        self.timeout = timeout
+        self.io_timeout = io_timeout
+        # spawn: процессы не наследуют потоки и соединения бота, как при fork. Запускаемый модуль
+        # в них импортируется заново как __mp_main__, поэтому Bot.py создаёт свои объекты только в main()
+        self._context = multiprocessing.get_context('spawn')
+        self._process_pool = self._create_process_pool()
+        self._thread_pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='bot-io')
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    def _create_process_pool(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers=self.processes, mp_context=self._context, initializer=_warm_up)
+
+    async def warm_up(self):
+        """Запускает все процессы заранее, чтобы первая генерация не ждала импорта pandas"""
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(self._process_pool, _ping) for _ in range(self.processes)))
+
+    async def run(self, func: Callable, *args, timeout: float = None):
+        """Выполняет func(*args) в пуле процессов; func и аргументы должны сериализоваться pickle"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        await self._semaphore.acquire()
+        try:
+            future = asyncio.get_running_loop().run_in_executor(self._process_pool, functools.partial(func, *args))
+        except BaseException:
+            self._semaphore.release()
+            raise
+        future.add_done_callback(lambda _: self._semaphore.release())
+
+        try:
+            # shield: таймаут не отменяет задачу, иначе место освободилось бы раньше, чем процесс
+            return await asyncio.wait_for(asyncio.shield(future), timeout or self.timeout)
+        except BrokenProcessPool:
+            # Процесс пула аварийно завершился — следующие задачи пойдут в новый пул
+            print("Пул процессов повреждён, создаю новый")
+            self._process_pool.shutdown(wait=False, cancel_futures=True)
+            self._process_pool = self._create_process_pool()
+            raise
+
+    async def run_io(self, func: Callable, *args, timeout: float = None):
+        """Выполняет func(*args) в пуле потоков — для чтения и записи файлов"""
+        future = asyncio.get_running_loop().run_in_executor(self._thread_pool, functools.partial(func, *args))
+        return await asyncio.wait_for(future, timeout or self.io_timeout)
+
+    def shutdown(self):
+        self._process_pool.shutdown(wait=False, cancel_futures=True)
+        self._thread_pool.shutdown(wait=False, cancel_futures=True)
+
+
+# === Задачи для пула процессов: функции модульного уровня без побочных эффектов при импорте ===
+def parse_upload(content: bytes, extension: str, max_rows: int, max_columns: int) -> Tuple[Optional[ParsedUpload], str]:
+    """Разбор загруженного файла: (данные, '') при успехе, (None, отчёт) при ошибках чтения или структуры,
+    (None, '') если файл не удалось обработать"""
+    # У каждой загрузки свой временный файл: одновременные загрузки одного пользователя не мешают друг другу
+    fd, file_path = tempfile.mkstemp(prefix='upload_', suffix=extension)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(content)
+    try:
+        processor = DataProcessor(file_path, max_rows=max_rows, max_columns=max_columns)
+
+        # Быстрая проверка структуры до полной обработки
+        if not processor.load_data():
+            return None, processor.validate().format_text()
+        report = processor.validate()
+        if not report.is_valid:
+            return None, report.format_text()
+
+        success, _, exercises = processor.process()
+        if not success or not exercises:
+            return None, ''
+        return ParsedUpload(group_records=processor.get_group_records(), exercises=exercises), ''
+    finally:
+        # Все данные уже в памяти, загруженный файл больше не нужен
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+
+async def generate_in_pool(workers: WorkerPool, generator: Union[ScheduleGenerator, MultiVenueScheduler],
+                           start_time: str, mode: str, timeout: float = None) -> Optional[ScheduleResult]:
+    """Генерация расписания в пуле: для нескольких залов — отдельная задача на каждый зал.
+
+    Залы считаются параллельно в пределах лимита одновременных задач WorkerPool, у каждой задачи
+    свой таймаут; расписания объединяются здесь, тексты и Excel строятся ещё одной задачей.
+    """
+    if not isinstance(generator, MultiVenueScheduler):
+        return await workers.run(build_schedule_result, generator, start_time, mode, timeout=timeout)
+
+    # Разбиение групп по залам дешёвое — в цикле событий, без лишней передачи данных в процесс
+    venues = generator.prepare_venues(mode)
+    results = await asyncio.gather(*(
+        workers.run(generate_venue_schedule, venue_generator, start_time, mode, None, None, timeout=timeout)
+        for venue_generator in venues.values()
+    ))
+    schedule = generator.merge_venue_schedules(dict(zip(venues, results)), mode)
+    if not schedule:
+        return None
+    return await workers.run(render_schedule_result, generator, schedule, timeout=timeout)
+
+
+def build_schedule_result(generator: Union[ScheduleGenerator, MultiVenueScheduler], start_time: str,
+                          mode: str) -> Optional[ScheduleResult]:
+    """Генерация и всё, что из неё получается: тексты по кортам, Excel, статистика, индекс просмотра.
+
+    None — если расписание пустое. Залы MultiVenueScheduler здесь считаются по очереди в этом же
+    процессе: вложенный пул обходил бы лимит WorkerPool, параллельно залы считает generate_in_pool.
+    """
+    schedule = generator.generate_schedule(start_time, mode=mode)
+    if not schedule:
+        return None
+    return render_schedule_result(generator, schedule)
+
+
+def render_schedule_result(generator: Union[ScheduleGenerator, MultiVenueScheduler],
+                           schedule: List[ScheduleSlot]) -> ScheduleResult:
+    """Тексты по кортам, Excel, статистика и индекс просмотра для готового расписания"""
+    return ScheduleResult(
+        schedule=schedule,
+        court_messages=generator.render_court_messages(schedule),
+        excel_bytes=generator.schedule_to_excel_bytes(schedule),
+        backfilled_minutes=generator.backfilled_minutes,
+        statistics=generator.schedule_statistics(schedule),
+        view_index=generator.view_index(schedule)
+    )
+
+
+def reschedule_subgroup(generator: Union[ScheduleGenerator, MultiVenueScheduler], schedule: List[ScheduleSlot],
+                        group: str, subgroup: str, field: str,
+                        value: str) -> Tuple[List[ScheduleSlot], int, bytes, ScheduleViewIndex]:
+    """Правка времени начала, числа участников или корта подгруппы с пересчётом расписания.
+
+    Следующие выступления на затронутых кортах и следующие этапы групп сдвигаются так, чтобы
+    ничего не пересекалось. Возвращает новое расписание, число сдвинутых выступлений, Excel и
+    индекс просмотра. ValueError — если правку нельзя применить. Генератор — после restore_state.
+    """
+    # Слоты копируются: исходные могут быть общими с кэшем результатов
+    schedule = [replace(slot, stage=replace(slot.stage)) for slot in schedule]
+    slots = sorted((slot for slot in schedule
+                    if slot.stage.group_name == group and slot.stage.subgroup_name == subgroup),
+                   key=lambda slot: (slot.start, slot.court))
+    if not slots:
+        raise ValueError("Подгруппа не найдена в расписании")
+
+    first = slots[0]
+    if isinstance(generator, MultiVenueScheduler):
+        venue_generator = generator.generators[first.venue]
+        rescheduler = generator.rescheduler(schedule, first.venue)
+    else:
+        venue_generator = generator
+        rescheduler = generator.rescheduler(schedule)
+
+    moved = {}
+    if field == "start_time":
+        # Время — в тот же день, что и прежнее начало
+        start = first.start - first.start % ScheduleGenerator.DAY_SECONDS + ScheduleGenerator.parse_start_time(value)
+        moved.update((id(slot), slot) for slot in rescheduler.update(first, start=start))
+    elif field == "participants":
+        participants = int(value)
+        duration = venue_generator.stage_duration(first.stage, participants)
+        first.stage.participants = participants
+        moved.update((id(slot), slot) for slot in rescheduler.update(first, duration=duration))
+    elif field == "kort":
+        court = int(value)
+        if court not in venue_generator.court_numbers:
+            raise ValueError(f"Нет корта {court}" + (f" в зале «{first.venue}»" if first.venue else ""))
+        # Этапы переносятся по очереди, каждый — на своё время на новом корте
+        for slot in slots:
+            moved.update((id(moved_slot), moved_slot) for moved_slot in rescheduler.update(slot, court=court))
+    else:
+        raise ValueError(f"Поле {field} не пересчитывается")
+
+    schedule.sort(key=lambda slot: (slot.start, slot.venue, slot.court))
+    return schedule, len(moved), generator.schedule_to_excel_bytes(schedule), generator.view_index(schedule)
+
+
+def write_file(path: str, content: bytes):
+    with open(path, 'wb') as f:
+        f.write(content)